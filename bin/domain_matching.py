@@ -11,11 +11,9 @@ import sys
 import time
 
 from certstream_analytics.analysers import AhoCorasickDomainMatching
-from certstream_analytics.analysers import WordSegmentation
 from certstream_analytics.analysers import DomainMatching, DomainMatchingOption
 from certstream_analytics.analysers import BulkDomainMarker
-from certstream_analytics.analysers import IDNADecoder
-from certstream_analytics.analysers import HomoglyphsDecoder
+from certstream_analytics.analysers import DomainPreprocessor
 from certstream_analytics.analysers import FeaturesGenerator
 from certstream_analytics.transformers import CertstreamTransformer
 from certstream_analytics.reporters import FileReporter
@@ -39,23 +37,20 @@ def init_analysers(domains_file, include_tld, matching_option):
     """
     Initialize all the analysers for matching domains. The list includes:
 
-    - IDNA
-    - Homoglyphs
+    - IDNA, homoglyphs, domain parser, and word segmentation (in one pass)
     - AhoCorasick
-    - Word segmentation
     - Bulk domains
     - Meta domain matching
     """
-    with open(domains_file) as fhandle:
-        domains = [line.rstrip() for line in fhandle]
+    # Split the whole file in one go instead of going through it line by line
+    with open(domains_file, 'rb') as fhandle:
+        domains = fhandle.read().decode('utf-8', 'ignore').splitlines()
 
     # Initialize all analysers. Note that their order is important cause they
     # will be executed in that order
     return [
-        IDNADecoder(),
-        HomoglyphsDecoder(greedy=False),
+        DomainPreprocessor(greedy=False),
         AhoCorasickDomainMatching(domains=domains),
-        WordSegmentation(),
         BulkDomainMarker(),
         DomainMatching(include_tld=include_tld, option=matching_option),
         FeaturesGenerator(),
@@ -117,6 +112,9 @@ Consume data from Certstream and does its magic.
 
     engine.stop()
 
+    if reporter:
+        reporter.close()
+
 
 if __name__ == '__main__':
     # Make sure that we can exit gracefully
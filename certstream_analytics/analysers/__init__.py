@@ -2,8 +2,10 @@
 from .base import Analyser, Debugger
 from .domain_matching import AhoCorasickDomainMatching
 from .domain_matching import DomainMatchingOption, DomainMatching
+from .common_domain_analyser import DomainParser
 from .common_domain_analyser import WordSegmentation
 from .common_domain_analyser import BulkDomainMarker
 from .common_domain_analyser import FeaturesGenerator
 from .common_domain_analyser import IDNADecoder
 from .common_domain_analyser import HomoglyphsDecoder
+from .common_domain_analyser import DomainPreprocessor
@@ -1,10 +1,11 @@
 """
 Analyse the certificate data from certstream.
 """
-import json
 import logging
 from abc import ABCMeta, abstractmethod
 
+from certstream_analytics import codec
+
 
 # pylint: disable=no-init,too-few-public-methods
 class Analyser:
@@ -13,6 +14,16 @@ class Analyser:
     """
     __metaclass__ = ABCMeta
 
+    # All the analyser classes, they register themselves here when they are defined
+    REGISTRY = set()
+
+    def __init_subclass__(cls, **kwargs):
+        """
+        Register the new analyser class.
+        """
+        super().__init_subclass__(**kwargs)
+        Analyser.REGISTRY.add(cls)
+
     @abstractmethod
     def run(self, record):
         """
@@ -45,6 +56,22 @@ class Analyser:
             }
         """
 
+    def run_batch(self, records):
+        """
+        Run the analyser on a batch of records and return the ones that make
+        it through. Analysers that can process the whole batch at once should
+        override this, otherwise the records are processed one by one.
+        """
+        results = []
+
+        for record in records:
+            record = self.run(record)
+
+            if record:
+                results.append(record)
+
+        return results
+
 
 class Debugger(Analyser):
     """
@@ -60,13 +87,12 @@ class Debugger(Analyser):
         '''
         This is a dummy analyser that will only print out the record it processes.
         '''
-        logging.info(json.dumps(record))
+        logging.info(codec.dumps(record))
 
         # Update the number of records so far
         self.count += 1
 
-        if 'analysers' not in record:
-            record['analysers'] = []
+        record.setdefault('analysers', [])
 
         record['analysers'].append({
             'analyser': type(self).__name__,
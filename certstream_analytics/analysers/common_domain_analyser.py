@@ -1,11 +1,14 @@
 """
 The list of basic analysers includes:
+    - DomainParser
     - WordSegmentation
     - IDNADecoder
     - HomoglyphsDecoder
     - FeaturesGenerator (generate various features for further downstream processing)
     - BulkDomainMarker
+    - DomainPreprocessor (IDNADecoder, HomoglyphsDecoder, DomainParser, and WordSegmentation in one pass)
 """
+import functools
 import re
 import tldextract
 import wordsegment
@@ -16,7 +19,66 @@ from confusable_homoglyphs import confusables
 from .base import Analyser
 
 
+def parse_domains(record):
+    """
+    Return the parsed representation of all the SAN domains in the record. The
+    domains that DomainParser has already seen come straight from its cache.
+    """
+    return [DomainParser.parse(domain) for domain in record['all_domains']]
+
+
 # pylint: disable=too-few-public-methods
+class DomainParser(Analyser):
+    """
+    Parse all the SAN domains once with tldextract and keep the result in a cache
+    so that the analysers running after this one don't need to do the same work
+    again. The cache is keyed by domain and lives outside of the record, so none
+    of it ends up in the reports. The parsed representation of a domain is as
+    follows and must not be modified as it's shared by everyone:
+
+        {
+            raw: THE ORIGINAL DOMAIN,
+            name: THE DOMAIN WITHOUT WILDCARD,
+            sub: SUBDOMAIN,
+            dom: DOMAIN,
+            tld: TLD,
+            joined: SUBDOMAIN.DOMAIN,
+        }
+
+    Note that the list of domains can be changed by other analysers such as
+    IDNADecoder or HomoglyphsDecoder, so this one needs to run after them.
+    """
+    # The same domains keep coming back in certstream, i.e. Let's Encrypt renewals
+    CACHE_SIZE = 65536
+
+    @staticmethod
+    @functools.lru_cache(maxsize=CACHE_SIZE)
+    def parse(domain):
+        """
+        Parse a single domain, or get it from the cache.
+        """
+        # Remove wildcard
+        name = re.sub(r'^\*\.', '', domain)
+        ext = tldextract.extract(name)
+
+        return {
+            'raw': domain,
+            'name': name,
+            'sub': ext.subdomain,
+            'dom': ext.domain,
+            'tld': ext.suffix,
+            'joined': '{}.{}'.format(ext.subdomain, ext.domain) if ext.subdomain else ext.domain,
+        }
+
+    def run(self, record):
+        """
+        Parse the domains of the record and keep them in the cache. The record
+        itself is left untouched.
+        """
+        parse_domains(record)
+        return record
+
+
 class WordSegmentation(Analyser):
     """
     Perform word segmentation of all the SAN domains as an attempt to make sense
@@ -55,39 +117,53 @@ class WordSegmentation(Analyser):
         """
         wordsegment.load()
 
+    def __getstate__(self):
+        """
+        Make sure that __setstate__ is always called when unpickling.
+        """
+        return self.__dict__
+
+    def __setstate__(self, state):
+        """
+        The wordsegment package needs to be loaded again when the analyser is
+        unpickled in another process.
+        """
+        self.__dict__.update(state)
+        wordsegment.load()
+
+    @staticmethod
+    def segment(parsed):
+        """
+        Segment a single parsed domain (see DomainParser).
+        """
+        words = []
+        # We choose to segment the TLD here as well, for example, .co.uk
+        # will become ['co', 'uk']. Let see if this works out.
+        for part in (parsed['sub'], parsed['dom'], parsed['tld']):
+            for token in part.split('.'):
+                segmented = [w for w in wordsegment.segment(token) if w not in WordSegmentation.STOPWORDS]
+
+                if segmented:
+                    words.extend(segmented)
+                elif token:
+                    # For some IDNA domain like xn--wgbfq3d.xn--ngbc5azd, the segmentation
+                    # won't work and an empty array is returned. So we choose to just keep
+                    # the original token
+                    words.append(token)
+
+        return words
+
     def run(self, record):
         """
         Apply word segment to all the SAN domain names. Let's see if it makes
         any sense.
         """
-        if 'analysers' not in record:
-            record['analysers'] = []
+        record.setdefault('analysers', [])
 
         results = {}
         # Check the domain and all its SAN
-        for domain in record['all_domains']:
-            # Remove wild card
-            domain = re.sub(r'^\*\.', '', domain)
-
-            # The TLD will be stripped off cause it does not contribute anything here
-            ext = tldextract.extract(domain)
-
-            words = []
-            # We choose to segment the TLD here as well, for example, .co.uk
-            # will become ['co', 'uk']. Let see if this works out.
-            for part in ext[:]:
-                for token in part.split('.'):
-                    segmented = [w for w in wordsegment.segment(token) if w not in WordSegmentation.STOPWORDS]
-
-                    if segmented:
-                        words.extend(segmented)
-                    elif token:
-                        # For some IDNA domain like xn--wgbfq3d.xn--ngbc5azd, the segmentation
-                        # won't work and an empty array is returned. So we choose to just keep
-                        # the original token
-                        words.append(token)
-
-            results[domain] = words
+        for parsed in parse_domains(record):
+            results[parsed['name']] = WordSegmentation.segment(parsed)
 
         if results:
             record['analysers'].append({
@@ -121,8 +197,7 @@ class BulkDomainMarker(Analyser):
         the indicator for now. So if a record has more SAN names than the
         threshold, it is a bulk record.
         """
-        if 'analysers' not in record:
-            record['analysers'] = []
+        record.setdefault('analysers', [])
 
         is_bulked = len(record['all_domains']) >= self.threshold
 
@@ -138,37 +213,39 @@ class IDNADecoder(Analyser):
     """
     Decode all domains in IDNA format.
     """
-    def run(self, record):
+    @staticmethod
+    def decode(domain):
         """
-        Check if a domain in the list is in IDNA format and convert it back to
-        Unicode.
+        Convert a single domain back to Unicode if it's in IDNA format.
         """
-        decoded = []
+        wildcard = False
 
-        for domain in record['all_domains']:
-            wildcard = False
-
-            try:
-                if re.match(r'^\*\.', domain):
-                    wildcard = True
-                    # Remove wildcard cause it interfere with the IDNA module
-                    # and we'll put it back later
-                    domain = re.sub(r'^\*\.', '', domain)
+        try:
+            if re.match(r'^\*\.', domain):
+                wildcard = True
+                # Remove wildcard cause it interfere with the IDNA module
+                # and we'll put it back later
+                domain = re.sub(r'^\*\.', '', domain)
 
-                domain = idna.decode(domain)
+            domain = idna.decode(domain)
 
-            except idna.core.InvalidCodepoint:
-                # Fail to decode the domain, just keep it as it is for now
-                pass
-            except UnicodeError:
-                pass
-            finally:
-                if wildcard:
-                    domain = '*.{}'.format(domain)
+        except idna.core.InvalidCodepoint:
+            # Fail to decode the domain, just keep it as it is for now
+            pass
+        except UnicodeError:
+            pass
+        finally:
+            if wildcard:
+                domain = '*.{}'.format(domain)
 
-            decoded.append(domain)
+        return domain
 
-        record['all_domains'] = decoded
+    def run(self, record):
+        """
+        Check if a domain in the list is in IDNA format and convert it back to
+        Unicode.
+        """
+        record['all_domains'] = [IDNADecoder.decode(domain) for domain in record['all_domains']]
         return record
 
 
@@ -206,56 +283,66 @@ class HomoglyphsDecoder(Analyser):
 
         return True
 
-    def run(self, record):
+    def decode(self, domain):
         """
-        Using the confusable-homoglyphs, we are going to generate all alternatives ASCII
-        names of a domain.  It's a bit of a brute force though.
+        Return the alternative ASCII names of a single domain. Only the first one
+        is returned if the greedy flag is not set.
         """
         decoded = []
+        wildcard = False
 
-        for domain in record['all_domains']:
-            wildcard = False
+        if re.match(r'^\*\.', domain):
+            wildcard = True
+            # Remove wild card to simplify the domain name a bit and we'll put it back later
+            domain = re.sub(r'^\*\.', '', domain)
 
-            if re.match(r'^\*\.', domain):
-                wildcard = True
-                # Remove wild card to simplify the domain name a bit and we'll put it back later
-                domain = re.sub(r'^\*\.', '', domain)
+        hg_map = {hg['character']: hg for hg in confusables.is_confusable(domain, greedy=True)}
+        decoded_domain_c = []
 
-            hg_map = {hg['character']: hg for hg in confusables.is_confusable(domain, greedy=True)}
-            decoded_domain_c = []
+        for domain_c in domain:
+            # Confusable homoglyphs could not find any homoglyphs for this character
+            # so we decide to keep the original character as it is
+            if domain_c not in hg_map:
+                decoded_domain_c.append([domain_c])
+                continue
 
-            for domain_c in domain:
-                # Confusable homoglyphs could not find any homoglyphs for this character
-                # so we decide to keep the original character as it is
-                if domain_c not in hg_map:
-                    decoded_domain_c.append([domain_c])
-                    continue
+            found = []
+            hglyph = hg_map[domain_c]
 
-                found = []
-                hglyph = hg_map[domain_c]
+            if hglyph['alias'] == 'LATIN':
+                # The character is Latin, we don't need to do anything here
+                found.append(hglyph['character'])
 
-                if hglyph['alias'] == 'LATIN':
-                    # The character is Latin, we don't need to do anything here
-                    found.append(hglyph['character'])
+            for alt in hglyph['homoglyphs']:
+                if HomoglyphsDecoder.is_latin(alt['c']):
+                    found.append(alt['c'].lower())
 
-                for alt in hglyph['homoglyphs']:
-                    if HomoglyphsDecoder.is_latin(alt['c']):
-                        found.append(alt['c'].lower())
+            # If nothing is found, we keep the original character
+            if not found:
+                found.append(hglyph['character'])
 
-                # If nothing is found, we keep the original character
-                if not found:
-                    found.append(hglyph['character'])
+            decoded_domain_c.append(found)
 
-                decoded_domain_c.append(found)
+        for alt in self._generate_alternatives(decoded_domain_c):
+            if wildcard:
+                alt = '*.{}'.format(alt)
 
-            for alt in self._generate_alternatives(decoded_domain_c):
-                if wildcard:
-                    alt = '*.{}'.format(alt)
+            decoded.append(alt)
 
-                decoded.append(alt)
+            if not self.greedy:
+                break
 
-                if not self.greedy:
-                    break
+        return decoded
+
+    def run(self, record):
+        """
+        Using the confusable-homoglyphs, we are going to generate all alternatives ASCII
+        names of a domain.  It's a bit of a brute force though.
+        """
+        decoded = []
+
+        for domain in record['all_domains']:
+            decoded.extend(self.decode(domain))
 
         record['all_domains'] = decoded
         return record
@@ -275,6 +362,49 @@ class HomoglyphsDecoder(Analyser):
                                                        current + alt_c)
 
 
+class DomainPreprocessor(Analyser):
+    """
+    Decode, parse, and segment each domain in one go instead of running IDNADecoder,
+    HomoglyphsDecoder, DomainParser, and WordSegmentation one after another, each
+    of them going through the whole list of domains. The record ends up the same
+    either way and the segmentation is still reported as WordSegmentation so that
+    the analysers running after this one can find it.
+    """
+    def __init__(self, greedy=False):
+        """
+        The greedy flag is passed to HomoglyphsDecoder.
+        """
+        self.homoglyphs = HomoglyphsDecoder(greedy=greedy)
+        # This also loads the wordsegment package
+        self.segmentation = WordSegmentation()
+
+    def run(self, record):
+        """
+        Run all the steps on each domain.
+        """
+        record.setdefault('analysers', [])
+
+        decoded = []
+        results = {}
+
+        for domain in record['all_domains']:
+            for alt in self.homoglyphs.decode(IDNADecoder.decode(domain)):
+                parsed = DomainParser.parse(alt)
+
+                decoded.append(alt)
+                results[parsed['name']] = WordSegmentation.segment(parsed)
+
+        record['all_domains'] = decoded
+
+        if results:
+            record['analysers'].append({
+                'analyser': WordSegmentation.__name__,
+                'output': results,
+            })
+
+        return record
+
+
 class FeaturesGenerator(Analyser):
     """
     Generate features to detect outliers in the stream. In our case, the outliers is
@@ -292,8 +422,7 @@ class FeaturesGenerator(Analyser):
         - The length of the TLD, e.g. .online or .download is longer than .com.
         - The randomness level of the domain.
         """
-        if 'analysers' not in record:
-            record['analysers'] = []
+        record.setdefault('analysers', [])
 
         x_samples = []
         Y_samples = []
@@ -3,18 +3,24 @@ Verify the domain against the list of most popular domains from OpenDNS
 (https://github.com/opendns/public-domain-lists). Let's see how useful
 it is to prevent phishing domains.
 """
+from bisect import bisect_right
 from enum import Enum
+from itertools import accumulate
 
-import json
 import logging
 import re
+import sys
 import tldextract
 import ahocorasick
 import wordsegment
 
+from certstream_analytics import codec
+
 from .base import Analyser
 from .common_domain_analyser import BulkDomainMarker
+from .common_domain_analyser import DomainParser
 from .common_domain_analyser import WordSegmentation
+from .common_domain_analyser import parse_domains
 
 
 # pylint: disable=too-few-public-methods
@@ -33,8 +39,12 @@ class AhoCorasickDomainMatching(Analyser):
         'web': 1,
     }
 
-    # Some common domain parts that cause too many FP
-    IGNORED_PARTS = r'^(autodiscover\.|cpanel\.)'
+    # Some common domain parts that cause too many FP. The pattern is compiled
+    # once here cause it's checked against every domain
+    IGNORED_PARTS = re.compile(r'^(autodiscover\.|cpanel\.)')
+
+    # Used to join the domains so that they can be matched in one go
+    SEPARATOR = '\x00'
 
     def __init__(self, domains):
         """
@@ -44,7 +54,7 @@ class AhoCorasickDomainMatching(Analyser):
         self.automaton = ahocorasick.Automaton()
         self.domains = {}
 
-        for index, domain in enumerate(domains):
+        for domain in domains:
             # Processing only the domain part.  All sub-domains or TLDs will
             # be ignored, for example:
             #   - www.google.com becomes google
@@ -55,8 +65,13 @@ class AhoCorasickDomainMatching(Analyser):
             if ext.domain in AhoCorasickDomainMatching.EXCLUDED_DOMAINS:
                 continue
 
-            self.automaton.add_word(ext.domain, (index, ext.domain))
-            self.domains[ext.domain] = domain
+            # Intern the strings here so that they are shared across all the
+            # matches reported later on. The key itself is the only value
+            # needed when it's matched
+            key = sys.intern(ext.domain)
+
+            self.automaton.add_word(key, key)
+            self.domains[key] = sys.intern(domain)
 
         self.automaton.make_automaton()
 
@@ -72,31 +87,97 @@ class AhoCorasickDomainMatching(Analyser):
         length of 2 or less.  So we choose to ignore those.  Also, we will
         prefer longer match than a shorter one for now.
         """
-        if 'analysers' not in record:
-            record['analysers'] = []
+        targets = self._targets(record)
+        # Check the domain and all its SAN in one pass
+        matches = self._scan([text for _, text in targets])
 
-        results = {}
-        # Check the domain and all its SAN
-        for domain in record['all_domains']:
-            # Remove wildcard
-            domain = re.sub(r'^\*\.', '', domain)
+        return self._save(record, targets, matches)
+
+    def run_batch(self, records):
+        """
+        Same as run but all the domains of all the records are matched in one
+        pass over the automaton.
+        """
+        targets = [self._targets(record) for record in records]
+        matches = self._scan([text for record_targets in targets for _, text in record_targets])
+
+        start = 0
+        for record, record_targets in zip(records, targets):
+            end = start + len(record_targets)
+            self._save(record, record_targets, matches[start:end])
+            start = end
+
+        return records
+
+    def has_match(self, text):
+        """
+        Quickly check if any domain in the list appears anywhere in the text,
+        for example, a raw record before it's parsed. This is looser than run
+        as nothing is stripped from the text beforehand.
+        """
+        for _, match in self.automaton.iter(text):
+            if len(match) >= AhoCorasickDomainMatching.MIN_MATCHING_LENGTH:
+                return True
+
+        return False
+
+    @staticmethod
+    def _targets(record):
+        """
+        Return the list of domains of the record together with the text that
+        will be matched against the automaton.
+        """
+        targets = []
+
+        for parsed in parse_domains(record):
+            domain = parsed['name']
 
             # Remove some FP-prone parts
-            domain = re.sub(AhoCorasickDomainMatching.IGNORED_PARTS, '', domain)
+            stripped = AhoCorasickDomainMatching.IGNORED_PARTS.sub('', domain)
+            if stripped != domain:
+                domain = stripped
+                parsed = DomainParser.parse(domain)
 
             # Similar to all domains in the list, the TLD will be stripped off
-            ext = tldextract.extract(domain)
-            # The match will be a tuple in the following format: (5, (0, 'google'))
-            matches = [m[1][1] for m in self.automaton.iter('.'.join(ext[:2]))
-                       if len(m[1][1]) >= AhoCorasickDomainMatching.MIN_MATCHING_LENGTH]
+            targets.append((domain, parsed['joined']))
+
+        return targets
+
+    def _scan(self, texts):
+        """
+        Find the longest match in each text. All texts are joined with a
+        separator that can't appear in any domain, so the automaton only
+        needs to run once over all of them. The matches (None if nothing is
+        found) are returned in the same order as the texts.
+        """
+        # The end of each text in the joined string, including its separator
+        ends = list(accumulate(len(text) + 1 for text in texts))
+        matches = [None] * len(texts)
+
+        # The match will be a tuple in the following format: (5, 'google')
+        for end_index, match in self.automaton.iter(AhoCorasickDomainMatching.SEPARATOR.join(texts)):
+            if len(match) < AhoCorasickDomainMatching.MIN_MATCHING_LENGTH:
+                continue
+
+            index = bisect_right(ends, end_index)
+            # Prefer the longer match
+            if not matches[index] or len(match) >= len(matches[index]):
+                matches[index] = match
 
-            if matches:
-                matches.sort(key=len)
+        return matches
 
-                match = matches[-1]
+    def _save(self, record, targets, matches):
+        """
+        Save the first matching domain into the record.
+        """
+        record.setdefault('analysers', [])
+
+        results = {}
+        for (domain, _), match in zip(targets, matches):
+            if match:
                 # We only keep the the longest match of the first matching domain
                 # for now
-                results[domain] = [self.domains[match]] if match in self.domains else match
+                results[sys.intern(domain)] = [self.domains[match]] if match in self.domains else match
                 break
 
         if results:
@@ -139,6 +220,14 @@ class DomainMatching(Analyser):
             DomainMatchingOption.ORDER_MATCH: list,
         }[option]
 
+    def __setstate__(self, state):
+        """
+        The wordsegment package needs to be loaded again when the analyser is
+        unpickled in another process.
+        """
+        self.__dict__.update(state)
+        wordsegment.load()
+
     def run(self, record):
         """
         Note that a meta-analyser will need to run after other analysers have
@@ -180,7 +269,8 @@ class DomainMatching(Analyser):
             })
 
             # DEBUG
-            logging.info(json.dumps(record))
+            if logging.getLogger().isEnabledFor(logging.INFO):
+                logging.info(codec.dumps(record))
 
         return record
 
@@ -205,7 +295,7 @@ class DomainMatching(Analyser):
                 continue
 
             phish = self.option(segmentation_output[match])
-            match_ext = tldextract.extract(match)
+            match_parsed = DomainParser.parse(match)
 
             for domain in domains:
                 ext = tldextract.extract(domain)
@@ -213,7 +303,7 @@ class DomainMatching(Analyser):
                 # This record is from a legitimate source, for example, agrosupport.zendesk.com
                 # will match with zendesk.com. In our case, we don't really care about this so
                 # it will be ignored and not reported as a match.
-                if ext[1:] == match_ext[1:]:
+                if (ext.domain, ext.suffix) == (match_parsed['dom'], match_parsed['tld']):
                     continue
 
                 tmp = []
@@ -0,0 +1,41 @@
+"""
+Serialize the records to JSON and back. The fast orjson package is used if
+it's available, otherwise the standard json module is good enough.
+"""
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps(obj):
+    """
+    Serialize the object into a JSON string.
+    """
+    if orjson:
+        return orjson.dumps(obj).decode('utf-8')
+
+    return json.dumps(obj)
+
+
+def dumpline(obj):
+    """
+    Serialize the object into a line of UTF-8 encoded JSON, ready to be
+    written to a binary file.
+    """
+    if orjson:
+        return orjson.dumps(obj, option=orjson.OPT_APPEND_NEWLINE)
+
+    return (json.dumps(obj) + '\n').encode('utf-8')
+
+
+def loads(raw):
+    """
+    Parse a JSON string (or bytes) into an object.
+    """
+    if orjson:
+        return orjson.loads(raw)
+
+    return json.loads(raw)
@@ -1,9 +1,10 @@
 """
 Report the analysis result somewhere.
 """
-import json
 from abc import ABCMeta, abstractmethod
 
+from certstream_analytics import codec
+
 
 # pylint: disable=no-init,too-few-public-methods
 class Reporter:
@@ -12,24 +13,58 @@ class Reporter:
     """
     __metaclass__ = ABCMeta
 
+    # All the reporter classes, they register themselves here when they are defined
+    REGISTRY = set()
+
+    def __init_subclass__(cls, **kwargs):
+        """
+        Register the new reporter class.
+        """
+        super().__init_subclass__(**kwargs)
+        Reporter.REGISTRY.add(cls)
+
     @abstractmethod
     def publish(self, report):
         """
         Move along, nothing to see here.
         """
 
+    def publish_many(self, reports):
+        """
+        Publish a batch of reports. Reporters that can send them all at once,
+        for example, in a single email, should override this. Otherwise, they
+        are published one by one.
+        """
+        for report in reports:
+            self.publish(report)
+
 
 class FileReporter(Reporter):
     """
     Simply print the report to a file.
     """
+    # The reports are buffered and written to the file in chunks of this size
+    BUFFER_SIZE = 64 * 1024
+
     def __init__(self, path):
         """
         Note that an exception will be raised if the path is not valid or writable.
         """
-        self.fhandler = open(path, 'a')
+        self.fhandler = open(path, 'ab', buffering=FileReporter.BUFFER_SIZE)
 
     def __del__(self):
+        self.close()
+
+    def flush(self):
+        """
+        Write all the buffered reports to the file.
+        """
+        self.fhandler.flush()
+
+    def close(self):
+        """
+        Flush the remaining reports and close the file.
+        """
         self.fhandler.close()
 
     def publish(self, report):
@@ -40,4 +75,10 @@ class FileReporter(Reporter):
         if not report:
             return
 
-        print(json.dumps(report), file=self.fhandler)
+        self.fhandler.write(codec.dumpline(report))
+
+    def publish_many(self, reports):
+        """
+        Write all the reports with a single call.
+        """
+        self.fhandler.write(b''.join(codec.dumpline(report) for report in reports if report))
@@ -11,8 +11,26 @@ class Storage:
     """
     __metaclass__ = ABCMeta
 
+    # All the storage classes, they register themselves here when they are defined
+    REGISTRY = set()
+
+    def __init_subclass__(cls, **kwargs):
+        """
+        Register the new storage class.
+        """
+        super().__init_subclass__(**kwargs)
+        Storage.REGISTRY.add(cls)
+
     @abstractmethod
     def save(self, record):
         """
         Move along, nothing to see here.
         """
+
+    def save_many(self, records):
+        """
+        Save a batch of records. Storages that support bulk operations should
+        override this, otherwise the records are saved one by one.
+        """
+        for record in records:
+            self.save(record)
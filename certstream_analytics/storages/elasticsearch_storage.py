@@ -3,11 +3,15 @@ Save certstream data into Elasticsearch so that it can be queried by Kibana
 later on.
 """
 from datetime import datetime
+from elasticsearch.helpers import bulk
 from elasticsearch_dsl import connections, analyzer
 from elasticsearch_dsl import Document, Date, Text, Keyword
 
 from .base import Storage
 
+# Use daily indices
+INDEX_FORMAT = 'certstream-%Y.%m.%d'
+
 ANALYZER = analyzer('standard_analyzer',
                     tokenizer='standard_tokenizer',
                     filter=['lowercase'])
@@ -18,6 +22,12 @@ class ElasticsearchStorage(Storage):
     """
     An experiment Elasticsearch storage to keep and index the received records.
     """
+    # The number of records sent in each bulk request
+    BULK_CHUNK_SIZE = 500
+
+    # Bulk requests take longer than normal ones
+    BULK_TIMEOUT = 60
+
     class Record(Document):
         """
         An Elasticsearch record as it is.
@@ -51,10 +61,22 @@ class ElasticsearchStorage(Storage):
             """
             self.timestamp = datetime.now()
             # Override the index to go to the proper timeslot
-            kwargs['index'] = self.timestamp.strftime('certstream-%Y.%m.%d')
+            kwargs['index'] = self.timestamp.strftime(INDEX_FORMAT)
 
             return super().save(**kwargs)
 
+        def to_action(self):
+            """
+            Convert the record into an action for the bulk API.
+            """
+            self.timestamp = datetime.now()
+            # Override the index to go to the proper timeslot. This needs to be
+            # done before converting the record cause the default index is a
+            # wildcard which can't be written to
+            self.meta.index = self.timestamp.strftime(INDEX_FORMAT)
+
+            return self.to_dict(include_meta=True)
+
     def __init__(self, hosts, timeout=10):
         """
         Provide the Elasticsearch hostname (Defaults to localhost).
@@ -65,6 +87,25 @@ class ElasticsearchStorage(Storage):
         """
         Save the certstream record in Elasticsearch.
         """
+        self._convert(record).save()
+
+    def save_many(self, records, refresh=False):
+        """
+        Save all the certstream records in Elasticsearch using its bulk API.
+        Set refresh to 'wait_for' to only return once the records can be
+        searched.
+        """
+        bulk(connections.get_connection(),
+             (self._convert(record).to_action() for record in records),
+             chunk_size=ElasticsearchStorage.BULK_CHUNK_SIZE,
+             request_timeout=ElasticsearchStorage.BULK_TIMEOUT,
+             refresh=refresh)
+
+    @staticmethod
+    def _convert(record):
+        """
+        Convert the certstream record into an Elasticsearch record.
+        """
         elasticsearch_record = ElasticsearchStorage.Record(meta={'id': record['cert_index']})
 
         # In miliseconds
@@ -76,4 +117,4 @@ class ElasticsearchStorage(Storage):
         elasticsearch_record.domain = record['all_domains'][0]
         elasticsearch_record.san = record['all_domains'][1:]
 
-        elasticsearch_record.save()
+        return elasticsearch_record
@@ -4,22 +4,151 @@ All hail [certstream](https://github.com/CaliDog/certstream-python)!!
 This module consumes the feed of certificates from certstream and does
 the heavy lifting.
 """
+import asyncio
+import logging
+import queue
+from collections import OrderedDict
 import sys
 import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import certstream
 
+try:
+    import websockets
+except ImportError:
+    websockets = None
+
+from certstream_analytics import codec
 from certstream_analytics.analysers import Analyser
 from certstream_analytics.reporters import Reporter
 from certstream_analytics.storages import Storage
 
+CERTSTREAM_URL = 'wss://certstream.calidog.io'
+
+# Heartbeats are tiny frames and the message type comes first in them
+HEARTBEAT = '"heartbeat"'
+HEARTBEAT_PREFIX_SIZE = 80
+
+# The analyser chain of a worker process, see _init_pipeline
+_CHAIN = None
+
+
+def _compile_chain(analysers):
+    """
+    Bind the run_batch method of all analysers once and return a single
+    function that runs them in order on a batch of records. The chain stops
+    as soon as no record is left.
+    """
+    runs = tuple(analyser.run_batch for analyser in analysers)
+
+    def chain(batch):
+        # Note that the order of analysers is extremely important cause the
+        # output of an analyser will be come the input of the next analyser
+        for run in runs:
+            # Run something here
+            batch = run(batch)
+
+            if not batch:
+                return []
+
+        return batch
+
+    return chain
+
+
+def _copy_record(record):
+    """
+    Copy the record so that it can be saved while the analysers are running
+    on the original. The analysers append their results to its list of
+    analysers, so that list is copied too.
+    """
+    copy = dict(record)
+
+    if 'analysers' in copy:
+        copy['analysers'] = list(copy['analysers'])
+
+    return copy
+
+
+def _init_pipeline(analysers):
+    """
+    Keep the analyser chain in the worker process so that the analysers are
+    pickled only once when the process starts instead of with every batch.
+    """
+    # pylint: disable=global-statement
+    global _CHAIN
+    _CHAIN = _compile_chain(analysers)
+
+
+def _run_pipeline(batch, chain=None):
+    """
+    Run the analyser chain on a batch of records and return the ones that make
+    it through. If no chain is given, the one set by _init_pipeline will be
+    used.
+    """
+    if chain is None:
+        chain = _CHAIN
+
+    return chain(batch)
+
+
+# pylint: disable=too-few-public-methods
+class Metrics():
+    """
+    Some simple counters to keep an eye on the consumer.
+    """
+    __slots__ = ('received', 'dropped')
+
+    def __init__(self):
+        """
+        Start counting from zero.
+        """
+        self.received = 0
+        self.dropped = 0
+
 
 class CertstreamAnalytics():
     """
     Consume the feed of certificates from certstream, transform the data, and
     save it into various storages.
     """
+    __slots__ = (
+        'transformer', 'apply', 'callback', 'analysers', 'reporters', 'storages', 'chain',
+        'batch_size', 'queue', 'metrics', 'dedup_size', 'seen',
+        'workers', 'pool', 'pending', 'storage_workers', 'storage_pool', 'storage_pending',
+        'reports', 'reports_lock',
+        'stopped', 'thread', 'worker', 'flusher',
+    )
+
+    # The maximum number of messages waiting to be processed
+    QUEUE_SIZE = 10000
 
-    def __init__(self, transformer=None, storages=None, analysers=None, reporters=None):
+    # The maximum number of messages processed in one go
+    BATCH_SIZE = 512
+
+    # The maximum number of batches waiting for each worker of the pools
+    PENDING_BATCHES_PER_WORKER = 2
+
+    # Publish the reports when there are this many of them
+    REPORT_BATCH_SIZE = 64
+
+    # or when this much time (in seconds) has passed
+    REPORT_INTERVAL = 0.2
+
+    # How often (in seconds) to log the number of dropped messages
+    METRICS_INTERVAL = 60
+
+    # How long to wait (in seconds) before reconnecting to certstream
+    RECONNECT_DELAY = 5
+
+    # The maximum size of a websocket frame, the certificate chain can be big
+    MAX_FRAME_SIZE = 2 ** 22
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, transformer=None, storages=None, analysers=None, reporters=None,
+                 queue_size=QUEUE_SIZE, batch_size=BATCH_SIZE, workers=None, storage_workers=None,
+                 dedup_size=0):
         """
         This is the entry point of the whole module. It consumes data from
         certstream, transform it using a Transformer class, save it into
@@ -39,8 +168,37 @@ class CertstreamAnalytics():
         The reporter, as its name implies, collects and publishes the analyser
         result somewhere, for example, email notification. It will be a subclass
         of CertstreamReporter.
+
+        Messages from certstream are queued up and then processed in batches
+        of at most batch_size messages by a separate worker thread so that
+        reading from certstream is not blocked by the processing pipeline.
+        If the pipeline can't keep up and the queue is full, the oldest
+        messages are dropped and counted in metrics. The pools below only take
+        a few batches per worker at a time, so the backlog stays in the queue.
+
+        If workers is set, the analysers will be run in a pool of that many
+        processes to make use of all the CPU cores. Note that each process
+        then has its own copy of the analysers, so their states, e.g. the
+        Debugger count, are not visible from here.
+
+        If storage_workers is set, the records will be saved into the storages
+        by a pool of that many threads. Saving is mostly waiting for network
+        I/O, so threads are good enough here. This is not the case for the
+        analysers which are CPU-bound, they should use workers instead.
+
+        The same certificate is usually submitted to several CT logs, so
+        certstream sends it more than once. If dedup_size is set, the last
+        dedup_size certificates, i.e. 100000, are remembered so that these
+        duplicates are dropped right away. It's 0 by default, so that all of
+        them are kept.
+
+        The reports are also buffered and published in batches, either when
+        there are REPORT_BATCH_SIZE of them or every REPORT_INTERVAL seconds.
         """
         self.transformer = transformer
+        # Bind the transformation and the callback handler once, see start()
+        self.apply = None
+        self.callback = None
 
         self.analysers = []
         self.reporters = []
@@ -57,20 +215,71 @@ class CertstreamAnalytics():
                     getattr(self, member).append(value)
 
                 for type_check in getattr(self, member):
-                    if not isinstance(type_check, kind):
+                    if type(type_check) not in kind.REGISTRY:
                         raise TypeError('Invalid {} type: {}'.format(member, type(type_check).__name__))
 
         _init_member('analysers', analysers, Analyser)
         _init_member('reporters', reporters, Reporter)
         _init_member('storages', storages, Storage)
 
+        # Run all the analysers in one go
+        self.chain = _compile_chain(self.analysers)
+
+        self.batch_size = batch_size
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.metrics = Metrics()
+
+        self.dedup_size = dedup_size
+        self.seen = OrderedDict()
+
+        self.workers = workers
+        self.pool = None
+        self.pending = None
+
+        self.storage_workers = storage_workers
+        self.storage_pool = None
+        self.storage_pending = None
+
+        self.reports = []
+        # The reports are added by the worker thread (or the process pool) and
+        # published by the flusher thread
+        self.reports_lock = threading.Lock()
+
         self.stopped = True
         self.thread = None
+        self.worker = None
+        self.flusher = None
 
     def start(self):
         """
         Start consuming data from certstream.
         """
+        self.stopped = False
+        self.apply = self.transformer.apply if self.transformer else None
+        self.callback = self._build_callback()
+
+        if self.workers and self.analysers:
+            self.pool = ProcessPoolExecutor(max_workers=self.workers,
+                                            initializer=_init_pipeline,
+                                            initargs=(self.analysers,))
+            self.pending = threading.BoundedSemaphore(
+                self.workers * CertstreamAnalytics.PENDING_BATCHES_PER_WORKER)
+
+        if self.storage_workers and self.storages:
+            self.storage_pool = ThreadPoolExecutor(max_workers=self.storage_workers)
+            self.storage_pending = threading.BoundedSemaphore(
+                self.storage_workers * CertstreamAnalytics.PENDING_BATCHES_PER_WORKER)
+
+        # Process the queued messages in a separate thread
+        self.worker = threading.Thread(target=self._drain)
+        self.worker.daemon = True
+        self.worker.start()
+
+        # and publish the reports periodically in another one
+        self.flusher = threading.Thread(target=self._flush_periodically)
+        self.flusher.daemon = True
+        self.flusher.start()
+
         # Run the stream in a separate thread
         self.thread = threading.Thread(target=self._consume)
         # So that it will be killed when the main thread stop
@@ -86,52 +295,291 @@ class CertstreamAnalytics():
 
         self.stopped = True
         self.thread.join()
+        self.worker.join()
+
+        if self.pool:
+            # Wait for all the pending batches to finish
+            self.pool.shutdown(wait=True)
+            self.pool = None
+
+        if self.storage_pool:
+            # Wait for all the pending writes to finish
+            self.storage_pool.shutdown(wait=True)
+            self.storage_pool = None
+
+        self.flusher.join()
+        # Publish whatever is left
+        self._flush()
 
     def _consume(self):
         """
-        Start consuming the data from certstream.
+        Start consuming the data from certstream. The websockets package is
+        used if it's available cause it's a lot faster than the certstream
+        client.
         """
-        self.stopped = False
-        # pylint: disable=unnecessary-lambda
-        certstream.listen_for_events(lambda m, c: self._callback(m, c),
-                                     url='wss://certstream.calidog.io')
+        if websockets:
+            asyncio.run(self._listen())
+            return
+
+        certstream.listen_for_events(self.callback, url=CERTSTREAM_URL)
 
-    # pylint: disable=unused-argument
-    def _callback(self, message, context):
+    async def _listen(self):
         """
-        The callback handler template itself.
+        Read the frames from certstream directly and reconnect if the
+        connection is lost.
         """
-        if self.stopped:
-            sys.exit()
+        callback = self.callback
+
+        while not self.stopped:
+            try:
+                # Skip the compression cause it only costs CPU here
+                async with websockets.connect(CERTSTREAM_URL,
+                                              max_size=CertstreamAnalytics.MAX_FRAME_SIZE,
+                                              compression=None) as websocket:
+                    while not self.stopped:
+                        frame = await websocket.recv()
+
+                        heartbeat = HEARTBEAT if isinstance(frame, str) else HEARTBEAT.encode()
+
+                        # Don't bother parsing the heartbeats
+                        if heartbeat in frame[:HEARTBEAT_PREFIX_SIZE]:
+                            continue
 
-        if message['message_type'] == 'heartbeat':
+                        callback(codec.loads(frame), None)
+
+            except (websockets.exceptions.WebSocketException, OSError) as error:
+                logging.error(error)
+                await asyncio.sleep(CertstreamAnalytics.RECONNECT_DELAY)
+
+    def _build_callback(self):
+        """
+        Build the callback handler for the current configuration. Whether the
+        duplicates are checked never changes once the consumer is started, so
+        it's decided here once instead of for every message.
+        """
+        enqueue = self._enqueue
+        is_duplicate = self._is_duplicate
+
+        # pylint: disable=unused-argument
+        def callback(message, context):
+            """
+            Only queue the certificate updates up so that the worker thread can
+            process them later. The heartbeats are ignored.
+            """
+            if self.stopped:
+                sys.exit()
+
+            if message.get('message_type') == 'certificate_update':
+                enqueue(message)
+
+        # pylint: disable=unused-argument
+        def dedup_callback(message, context):
+            """
+            Same as above but also drop the duplicated certificates.
+            """
+            if self.stopped:
+                sys.exit()
+
+            if message.get('message_type') == 'certificate_update' and not is_duplicate(message):
+                enqueue(message)
+
+        return dedup_callback if self.dedup_size else callback
+
+    def _is_duplicate(self, message):
+        """
+        Check if the certificate has been seen recently.
+        """
+        data = message['data']
+        # The fingerprint identifies the certificate across CT logs
+        key = data['leaf_cert'].get('fingerprint', data['cert_index'])
+
+        if key in self.seen:
+            self.seen.move_to_end(key)
+            return True
+
+        self.seen[key] = None
+        if len(self.seen) > self.dedup_size:
+            self.seen.popitem(last=False)
+
+        return False
+
+    def _enqueue(self, message):
+        """
+        Queue the message up for the worker thread.
+        """
+        self.metrics.received += 1
+        try:
+            self.queue.put_nowait(message)
+        except queue.Full:
+            # The pipeline can't keep up, so make room by dropping the oldest
+            # message instead of letting the backlog grow without bound
+            self.metrics.dropped += 1
+
+            try:
+                self.queue.get_nowait()
+                self.queue.put_nowait(message)
+            except (queue.Empty, queue.Full):
+                pass
+
+    def _drain(self):
+        """
+        Keep draining the queue and process the messages in batches until the
+        consumer is stopped.
+        """
+        while not self.stopped or not self.queue.empty():
+            try:
+                # Wait for the first message, but not forever so that we can
+                # notice when the consumer is stopped
+                batch = [self.queue.get(timeout=1)]
+            except queue.Empty:
+                continue
+
+            # then get whatever is already there
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            try:
+                self._process(batch)
+            # pylint: disable=broad-except
+            except Exception as error:
+                # Don't let a bad batch kill the worker thread
+                logging.exception(error)
+
+    def _process(self, batch):
+        """
+        Transform, save, analyse, and report a batch of messages.
+        """
+        apply = self.apply
+        if apply:
+            # Apply the user-defined transformation. The structure of the raw
+            # message is at See https://github.com/CaliDog/certstream-python/
+            batch = [apply(message) for message in batch]
+
+        batch = [message for message in batch if message]
+        if not batch:
             return
 
-        if message['message_type'] == 'certificate_update':
-            if self.transformer:
-                # Apply the user-defined transformation. The structure of the raw
-                # message is at See https://github.com/CaliDog/certstream-python/
-                transformed_message = self.transformer.apply(message)
-            else:
-                transformed_message = message
-
-            if self.storages and transformed_message:
-                # Save the message into a more permanent storage. May be we should
-                # support multiple storages in parallel here
-                for storage in self.storages:
-                    storage.save(transformed_message)
-
-            if self.analysers:
-                # Note that the order of analysers is extremely important cause the
-                # output of an analyser will be come the input of the next analyser
-                for analyser in self.analysers:
-                    if not transformed_message:
-                        break
-
-                    # Run something here
-                    transformed_message = analyser.run(transformed_message)
-
-                if self.reporters and transformed_message:
-                    # and report the final result
-                    for reporter in self.reporters:
-                        reporter.publish(transformed_message)
+        if self.storage_pool:
+            # The analysers will modify the records while they are being saved,
+            # so the storages get their own copies
+            saved = [_copy_record(message) for message in batch]
+
+            for storage in self.storages:
+                self._submit(self.storage_pool, self.storage_pending, self._on_saved, storage.save_many, saved)
+        else:
+            # Save the messages into a more permanent storage
+            for storage in self.storages:
+                storage.save_many(batch)
+
+        if not self.analysers:
+            return
+
+        if self.pool:
+            self._submit(self.pool, self.pending, self._on_result, _run_pipeline, batch)
+        else:
+            self._report(_run_pipeline(batch, self.chain))
+
+    @staticmethod
+    def _submit(pool, pending, callback, func, *args):
+        """
+        Submit the work to the pool and call the callback with its future when
+        it's done. If there are already too many batches in flight, wait for
+        one of them to finish first. Otherwise, the backlog would just move from
+        the bounded queue into the unbounded work queue of the pool.
+        """
+        pending.acquire()
+
+        def done(future):
+            """
+            Make room for the next batch.
+            """
+            try:
+                callback(future)
+            finally:
+                pending.release()
+
+        try:
+            future = pool.submit(func, *args)
+        except BaseException:
+            pending.release()
+            raise
+
+        future.add_done_callback(done)
+
+    @staticmethod
+    def _on_saved(future):
+        """
+        Log the error if the records could not be saved.
+        """
+        error = future.exception()
+        if error:
+            logging.error(error)
+
+    def _on_result(self, future):
+        """
+        Report the result of a batch once a worker process finishes with it.
+        """
+        try:
+            self._report(future.result())
+        # pylint: disable=broad-except
+        except Exception as error:
+            logging.exception(error)
+
+    def _report(self, results):
+        """
+        Buffer the final result so that it can be reported in batches.
+        """
+        if not self.reporters or not results:
+            return
+
+        with self.reports_lock:
+            self.reports.extend(results)
+
+            if len(self.reports) < CertstreamAnalytics.REPORT_BATCH_SIZE:
+                return
+
+        self._flush()
+
+    def _flush(self):
+        """
+        Publish all the buffered reports.
+        """
+        with self.reports_lock:
+            if not self.reports:
+                return
+
+            reports, self.reports = self.reports, []
+
+            for reporter in self.reporters:
+                reporter.publish_many(reports)
+
+    def _flush_periodically(self):
+        """
+        Publish the buffered reports every REPORT_INTERVAL seconds until the
+        consumer is stopped. The number of dropped messages, if any, is also
+        logged every METRICS_INTERVAL seconds.
+        """
+        dropped = 0
+        logged_at = time.monotonic()
+
+        while not self.stopped:
+            time.sleep(CertstreamAnalytics.REPORT_INTERVAL)
+
+            try:
+                self._flush()
+            # pylint: disable=broad-except
+            except Exception as error:
+                logging.exception(error)
+
+            if time.monotonic() - logged_at < CertstreamAnalytics.METRICS_INTERVAL:
+                continue
+
+            logged_at = time.monotonic()
+            # Also let the user know if messages are being dropped
+            if self.metrics.dropped != dropped:
+                logging.warning('Dropped %d out of %d messages so far',
+                                self.metrics.dropped, self.metrics.received)
+                dropped = self.metrics.dropped
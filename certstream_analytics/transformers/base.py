@@ -3,6 +3,23 @@ Transform the certificate data from certstream before passing it to the
 processing pipeline.
 """
 from abc import ABCMeta, abstractmethod
+from operator import itemgetter
+
+# Extract the rest of the fields that we are interested in from the leaf
+# certificate once it has some domains
+LEAF_FIELDS = itemgetter('not_before', 'not_after')
+
+# The shape of the transformed record, so that all of them have the same keys
+# in the same order
+TEMPLATE = {
+    'cert_index': 0,
+    'seen': 0,
+    'chain': None,
+    'analysers': None,
+    'not_before': 0,
+    'not_after': 0,
+    'all_domains': None,
+}
 
 
 # pylint: disable=no-init,too-few-public-methods
@@ -10,6 +27,7 @@ class Transformer:
     """
     Define the template of all transformer class.
     """
+    __slots__ = ()
     __metaclass__ = ABCMeta
 
     @abstractmethod
@@ -23,6 +41,8 @@ class PassthroughTransformer(Transformer):
     """
     A dummy transformer that doesn't do anything.
     """
+    __slots__ = ()
+
     def apply(self, raw):
         """
         Move along, nothing to see here.
@@ -35,6 +55,8 @@ class CertstreamTransformer(Transformer):
     Transform data from certstream into something readily consumable by the
     processing pipeline.
     """
+    __slots__ = ()
+
     def apply(self, raw):
         """
         The format of the message from certstream can be found at their github
@@ -67,19 +89,26 @@ class CertstreamTransformer(Transformer):
                 ],
             }
         """
-        filtered = {
-            'cert_index': raw['data']['cert_index'],
-            'seen': raw['data']['seen'],
-            'chain': [],
+        data = raw['data']
+        leaf = data['leaf_cert']
+
+        domains = leaf['all_domains']
+        if not domains:
+            return None
+
+        not_before, not_after = LEAF_FIELDS(leaf)
+
+        filtered = TEMPLATE.copy()
 
-            # The analyser result will be stored here later on
-            'analysers': [],
-        }
+        filtered['cert_index'] = data['cert_index']
+        filtered['seen'] = data['seen']
+        filtered['chain'] = [hop['subject'].get('O') for hop in data.get('chain', [])]
 
-        interested_fields = ['not_before', 'not_after', 'all_domains']
+        # The analyser result will be stored here later on
+        filtered['analysers'] = []
 
-        if raw['data']['leaf_cert']['all_domains']:
-            filtered.update({k: raw['data']['leaf_cert'][k] for k in interested_fields})
-            return filtered
+        filtered['not_before'] = not_before
+        filtered['not_after'] = not_after
+        filtered['all_domains'] = domains
 
-        return None
+        return filtered
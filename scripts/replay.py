@@ -3,16 +3,25 @@
 Replay a stream of records from certstream to test the processing pipeline.
 '''
 import argparse
+import collections
+import functools
+import io
 import json
 import logging
+import mmap
+import os
+import pickle
+import queue
+import socket
 import sys
+import threading
+from multiprocessing import Pool
 
+from certstream_analytics import codec
 from certstream_analytics.analysers import AhoCorasickDomainMatching
-from certstream_analytics.analysers import WordSegmentation
 from certstream_analytics.analysers import DomainMatching, DomainMatchingOption
 from certstream_analytics.analysers import BulkDomainMarker
-from certstream_analytics.analysers import IDNADecoder
-from certstream_analytics.analysers import HomoglyphsDecoder
+from certstream_analytics.analysers import DomainPreprocessor
 from certstream_analytics.analysers import FeaturesGenerator
 from certstream_analytics.reporters import FileReporter
 from certstream_analytics.storages import ElasticsearchStorage
@@ -26,34 +35,337 @@ SUPPORTED_STORAGES = {
     'elasticsearch': lambda host: ElasticsearchStorage(hosts=[host])
 }
 
+# The number of records processed in one go
+BATCH_SIZE = 512
 
-def init_analysers(domains_file, include_tld, matching_option):
+# The number of batches waiting to be saved or reported
+WRITER_QUEUE_SIZE = 16
+
+# The number of batches given to each worker of the pool at a time
+PENDING_BATCHES_PER_WORKER = 2
+
+# A larger read buffer for the (multi-GB) replay files
+READ_BUFFER_SIZE = 1 << 20
+
+# The size of the ranges of a memory-mapped replay file given to the workers
+MMAP_RANGE_SIZE = 1 << 22
+
+# The analysers of the current (worker) process, see init_worker
+ANALYSERS = []
+
+# Whether to skip the analysers whose output is already in the records
+RESUME = False
+
+# These analysers modify the record in place and don't report under their
+# own names. If a record already carries the output of other analysers, they
+# have already been run on it
+PREPROCESSORS = {
+    DomainPreprocessor.__name__,
+}
+
+
+@functools.lru_cache(maxsize=4)
+def load_ahocorasick(domains_file, mtime, cache=None):
+    '''
+    Build the Aho-Corasick analyser from the list of domains. Building the
+    automaton for a long list takes a while, so the analyser can be pickled
+    into a cache file and loaded from there next time as long as the list
+    hasn't changed since (its mtime is part of the key here for the same
+    reason). The cache is also rebuilt when the analyser itself has changed.
+    '''
+    mtime = max(mtime, os.path.getmtime(sys.modules[AhoCorasickDomainMatching.__module__].__file__))
+
+    if cache and os.path.exists(cache) and os.path.getmtime(cache) >= mtime:
+        with open(cache, 'rb') as fhandle:
+            return pickle.load(fhandle)
+
+    # Split the whole file in one go instead of going through it line by line
+    with open(domains_file, 'rb') as fhandle:
+        domains = fhandle.read().decode('utf-8', 'ignore').splitlines()
+
+    analyser = AhoCorasickDomainMatching(domains=domains)
+
+    if cache:
+        with open(cache, 'wb') as fhandle:
+            pickle.dump(analyser, fhandle, protocol=pickle.HIGHEST_PROTOCOL)
+
+    return analyser
+
+
+def init_analysers(domains_file, include_tld, matching_option, ac_cache=None):
     '''
     Initialize all the analysers for matching domains. The list includes:
 
-    - IDNA
-    - Homoglyphs
+    - IDNA, homoglyphs, domain parser, and word segmentation (in one pass)
     - AhoCorasick
-    - Word segmentation
     - Bulk domains
     - Meta domain matching
     '''
-    with open(domains_file) as fhandle:
-        domains = [line.rstrip() for line in fhandle]
-
     # Initialize all analysers. Note that their order is important cause they
     # will be executed in that order
     return [
-        IDNADecoder(),
-        HomoglyphsDecoder(greedy=False),
-        AhoCorasickDomainMatching(domains=domains),
-        WordSegmentation(),
+        DomainPreprocessor(greedy=False),
+        load_ahocorasick(domains_file, os.path.getmtime(domains_file), ac_cache),
         BulkDomainMarker(),
         DomainMatching(include_tld=include_tld, option=matching_option),
         FeaturesGenerator(),
     ]
 
 
+# pylint: disable=too-many-arguments
+def init_worker(domains_file, include_tld, matching_option, ac_cache=None, resume=False):
+    '''
+    Initialize the analysers once per process so that they don't need to be
+    pickled and sent over with every batch.
+    '''
+    # pylint: disable=global-statement
+    global ANALYSERS, RESUME
+    ANALYSERS = init_analysers(domains_file, include_tld, matching_option, ac_cache)
+    RESUME = resume
+
+
+def analyse(batch):
+    '''
+    Run all the analysers on a batch of records.
+    '''
+    if not RESUME:
+        for analyser in ANALYSERS:
+            # Run something here
+            batch = analyser.run_batch(batch)
+
+        return batch
+
+    # Note down what have already been done to each record before running
+    # anything on it
+    existing = []
+    for record in batch:
+        names = {analyser['analyser'] for analyser in record.get('analysers', [])}
+
+        if names:
+            names.update(PREPROCESSORS)
+
+        existing.append(names)
+
+    for analyser in ANALYSERS:
+        name = type(analyser).__name__
+        pending = [index for index, names in enumerate(existing)
+                   if name not in names and batch[index] is not None]
+
+        if not pending:
+            continue
+
+        # run_batch drops the records that don't make it through, so the
+        # positions of the results can't be trusted. The analysers update
+        # and return the same records, so look for them instead
+        kept = {id(record) for record in analyser.run_batch([batch[index] for index in pending])}
+        for index in pending:
+            if id(batch[index]) not in kept:
+                batch[index] = None
+
+    return [record for record in batch if record is not None]
+
+
+def copy_record(record):
+    '''
+    Copy the record so that it can be saved as it was before the analysers
+    run on it. The analysers append their results to its list of analysers,
+    so that list is copied too.
+    '''
+    copy = dict(record)
+
+    if 'analysers' in copy:
+        copy['analysers'] = list(copy['analysers'])
+
+    return copy
+
+
+def split_ranges(mapped, size=MMAP_RANGE_SIZE):
+    '''
+    Split a memory-mapped file into ranges of about the given size. Each range
+    ends right after a newline so that no record is cut in half.
+    '''
+    ranges = []
+    start = 0
+
+    while start < len(mapped):
+        end = mapped.find(b'\n', min(start + size, len(mapped)) - 1)
+        end = len(mapped) if end == -1 else end + 1
+
+        ranges.append((start, end))
+        start = end
+
+    return ranges
+
+
+def analyse_range(task):
+    '''
+    Parse and analyse all the records in a range of the replay file. Each
+    worker maps the file on its own, so the raw lines don't need to be sent
+    over from the main process. The records are also returned as they were
+    before being analysed if they need to be saved.
+    '''
+    path, start, end, save, use_prefilter = task
+
+    with open(path, 'rb') as fhandle:
+        with mmap.mmap(fhandle.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            lines = mapped[start:end].splitlines()
+
+    prefilter = None
+    if use_prefilter:
+        # The automaton is already loaded as one of the analysers
+        matcher = next(a for a in ANALYSERS if isinstance(a, AhoCorasickDomainMatching))
+        prefilter = functools.partial(prefilter_line, matcher)
+
+    saved = []
+    analysed = []
+
+    for batch in read_batches(lines, saved.extend if save else None, prefilter):
+        analysed.extend(analyse(batch))
+
+    return saved, analysed
+
+
+def start_writer(write):
+    '''
+    Call the write function on every batch put into the returned queue from
+    a background thread, so that waiting for the storage or the reporter
+    doesn't hold up the analysers. Put None into the queue to stop it.
+    '''
+    batches = queue.Queue(maxsize=WRITER_QUEUE_SIZE)
+
+    def _write():
+        for batch in iter(batches.get, None):
+            try:
+                write(batch)
+            # pylint: disable=broad-except
+            except Exception as error:
+                logging.exception(error)
+
+    thread = threading.Thread(target=_write, daemon=True)
+    thread.start()
+
+    return batches, thread
+
+
+def prefilter_line(matcher, raw):
+    '''
+    Check if the raw line from the replay file contains any domain from the
+    list. pyahocorasick automatons only work on str, so the bytes need to be
+    decoded. Only the list of domains is decoded and checked, if it can be
+    found, instead of the whole line with its keys and issuers.
+    '''
+    start = raw.find(b'"all_domains"')
+
+    if start != -1:
+        end = raw.find(b']', start)
+        raw = raw[start + len(b'"all_domains"'):end if end != -1 else len(raw)]
+
+    return matcher.has_match(raw.decode('utf-8', 'ignore'))
+
+
+def read_batches(fhandler, save=None, prefilter=None):
+    '''
+    Read the records from the replay file in batches. If save is set, it's
+    called with every batch of records to be saved before they are analysed.
+    If a prefilter is set, only the records whose lines pass it are analysed.
+    All the records are still saved, but the lines that don't pass are not
+    even parsed when nothing needs to be saved.
+    '''
+    batch = []
+    stored = []
+
+    for raw in fhandler:
+        wanted = not prefilter or prefilter(raw)
+
+        if not wanted and not save:
+            continue
+
+        try:
+            record = codec.loads(raw)
+        except json.decoder.JSONDecodeError:
+            continue
+
+        if save:
+            # The analysers will modify the records while they are being
+            # saved, so the storage gets its own copies
+            stored.append(copy_record(record))
+
+            if len(stored) >= BATCH_SIZE:
+                save(stored)
+                stored = []
+
+        if wanted:
+            batch.append(record)
+
+            if len(batch) >= BATCH_SIZE:
+                yield batch
+                batch = []
+
+    if stored:
+        save(stored)
+
+    if batch:
+        yield batch
+
+
+def imap_bounded(pool, func, iterable, window):
+    '''
+    Same as pool.imap but only take a few items from the iterable at a time.
+    The pool reads the whole iterable in the background otherwise, so the
+    whole replay file would end up in memory if the analysers are slower
+    than the reader.
+    '''
+    pending = collections.deque()
+
+    for item in iterable:
+        pending.append(pool.apply_async(func, (item,)))
+
+        if len(pending) >= window:
+            yield pending.popleft().get()
+
+    while pending:
+        yield pending.popleft().get()
+
+
+def replay_daemon(path, fhandler, prefilter=None):
+    '''
+    Send the records to a replay daemon (see replay_daemon.py) which already
+    has all the analysers loaded, and read the analysed records back in
+    batches.
+    '''
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        conn.connect(path)
+
+        # Send and receive at the same time so that neither side gets stuck
+        # waiting for the other one to read
+        def _send():
+            for raw in fhandler:
+                if prefilter and not prefilter(raw):
+                    continue
+
+                conn.sendall(raw)
+
+            conn.shutdown(socket.SHUT_WR)
+
+        sender = threading.Thread(target=_send, daemon=True)
+        sender.start()
+
+        with conn.makefile('rb') as responses:
+            batch = []
+
+            for raw in responses:
+                batch.append(codec.loads(raw))
+
+                if len(batch) >= BATCH_SIZE:
+                    yield batch
+                    batch = []
+
+            if batch:
+                yield batch
+
+        sender.join()
+
+
 def run():
     '''
     A simple utility to replay certstream and match the records to a list of
@@ -70,6 +382,10 @@ examples:
 
 \033[1;33m/usr/bin/replay.py --domains opendns-top-domains.txt\033[0m
 
+\033[1;33m/usr/bin/replay.py --domains opendns-top-domains.txt --ac-cache opendns-top-domains.pickle\033[0m
+
+\033[1;33m/usr/bin/replay.py --replay certstream.txt --daemon /tmp/replay.sock\033[0m
+
 Replay data from certstream.
 '''
     parser = argparse.ArgumentParser(description=__doc__, epilog=epilog,
@@ -79,6 +395,8 @@ Replay data from certstream.
                         help='the list of records from certstream (one per line)')
     parser.add_argument('--domains',
                         help='the list of domains to match with (opendns-top-domains.txt)')
+    parser.add_argument('--ac-cache',
+                        help='where to cache the Aho-Corasick automaton built from the list of domains')
 
     parser.add_argument('--storage-host', default='localhost:9200',
                         help='set the storage host')
@@ -90,6 +408,18 @@ Replay data from certstream.
     parser.add_argument('-r', '--report', default='file',
                         help='choose the reporter type')
 
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='the number of processes used to run the analysers')
+    parser.add_argument('--mmap', action='store_true',
+                        help='let the workers read the replay file directly by memory-mapping it')
+    parser.add_argument('--resume', action='store_true',
+                        help='skip the analysers whose output is already in the records')
+    parser.add_argument('--daemon',
+                        help='send the records to a replay daemon listening on this socket (see replay_daemon.py)')
+    parser.add_argument('--prefilter', action='store_true',
+                        help='only analyse the records whose raw domains contain one from the list '
+                             '(a loose check, IDNA and homoglyphs are not decoded)')
+
     try:
         args = parser.parse_args()
     # pylint: disable=broad-except
@@ -116,31 +446,95 @@ Replay data from certstream.
         # Encounter an unsupported storage type
         sys.exit(1)
 
-    analysers = init_analysers(domains_file=args.domains,
-                               include_tld=True,
-                               matching_option=DomainMatchingOption.ORDER_MATCH)
+    if args.daemon and args.storage:
+        logging.error('The records cannot be saved into a storage when using a replay daemon')
+        sys.exit(1)
 
-    if args.report:
-        reporter = SUPPORTED_REPORTERS[args.report](args.report_location)
+    reporter = SUPPORTED_REPORTERS[args.report](args.report_location) if args.report else None
+    storage = SUPPORTED_STORAGES[args.storage](args.storage_host) if args.storage else None
 
-    if args.storage:
-        storage = SUPPORTED_STORAGES[args.storage](args.storage_host)
+    analysers_args = (args.domains, True, DomainMatchingOption.ORDER_MATCH, args.ac_cache, args.resume)
 
-    with open(args.replay) as fhandler:
-        for raw in fhandler:
-            try:
-                record = json.loads(raw)
-            except json.decoder.JSONDecodeError:
-                continue
+    # Saving and reporting happen in the background
+    writers = []
+
+    saved = None
+    if storage:
+        saved, thread = start_writer(storage.save_many)
+        writers.append((saved, thread))
+
+    published = None
+    if reporter:
+        published, thread = start_writer(reporter.publish_many)
+        writers.append((published, thread))
+
+    use_mmap = args.mmap and args.workers > 1 and not args.daemon
+
+    prefilter = None
+    if args.prefilter and not use_mmap:
+        # Run the automaton over the raw line to skip analysing the records
+        # that can't match anything. This is only a loose pre-pass: nothing
+        # is stripped from the domains, so some records still get through
+        # and are left for the analysers to sort out
+        matcher = load_ahocorasick(args.domains, os.path.getmtime(args.domains), args.ac_cache)
+        prefilter = functools.partial(prefilter_line, matcher)
+
+    if use_mmap:
+        # The workers only get the start and end of their ranges and read the
+        # records straight from the file
+        if os.path.getsize(args.replay):
+            with open(args.replay, 'rb') as fhandle:
+                with mmap.mmap(fhandle.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    ranges = split_ranges(mapped)
+        else:
+            ranges = []
+
+        tasks = [(args.replay, start, end, bool(saved), args.prefilter) for start, end in ranges]
+
+        with Pool(args.workers, initializer=init_worker, initargs=analysers_args) as pool:
+            window = PENDING_BATCHES_PER_WORKER * args.workers
+
+            for saved_records, analysed in imap_bounded(pool, analyse_range, tasks, window):
+                if saved and saved_records:
+                    saved.put(saved_records)
+
+                if published and analysed:
+                    published.put(analysed)
+    else:
+        # Read the raw bytes cause the JSON parser doesn't need them to be decoded
+        with io.BufferedReader(io.FileIO(args.replay, 'r'), buffer_size=READ_BUFFER_SIZE) as fhandler:
+            if args.daemon:
+                # The analysers are already loaded by the daemon
+                batches = replay_daemon(args.daemon, fhandler, prefilter)
+            else:
+                batches = read_batches(fhandler, saved.put if saved else None, prefilter)
+
+            if args.daemon:
+                for batch in batches:
+                    if published:
+                        published.put(batch)
+            elif args.workers > 1:
+                # The records are independent from each other, so the analysers
+                # can run in parallel. Saving and reporting stay in this process
+                with Pool(args.workers, initializer=init_worker, initargs=analysers_args) as pool:
+                    for batch in imap_bounded(pool, analyse, batches, PENDING_BATCHES_PER_WORKER * args.workers):
+                        if published:
+                            published.put(batch)
+            else:
+                init_worker(*analysers_args)
+
+                for batch in map(analyse, batches):
+                    if published:
+                        published.put(batch)
 
-            if args.storage:
-                storage.save(record)
+    # Wait for the writers to finish
+    for batches, thread in writers:
+        batches.put(None)
+        thread.join()
 
-            for analyser in analysers:
-                # Run something here
-                record = analyser.run(record)
+    if reporter:
+        reporter.close()
 
-            reporter.publish(record)
 
 if __name__ == '__main__':
     run()
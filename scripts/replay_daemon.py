@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+'''
+Keep all the analysers loaded in a long running process so that replaying
+a small file doesn't need to wait for them to be initialized every time.
+The records are sent over a UNIX socket, one per line, and the analysed
+records are sent back the same way. See replay.py --daemon for the client.
+'''
+import argparse
+import logging
+import os
+import socketserver
+import sys
+
+from certstream_analytics import codec
+from certstream_analytics.analysers import DomainMatchingOption
+
+from replay import analyse, init_worker, read_batches
+
+
+class ReplayHandler(socketserver.StreamRequestHandler):
+    '''
+    Analyse all the records sent by a client and send them back.
+    '''
+    def handle(self):
+        '''
+        The records are analysed in batches as soon as they come in.
+        '''
+        for batch in read_batches(self.rfile):
+            output = ''.join(codec.dumps(record) + '\n' for record in analyse(batch))
+            self.wfile.write(output.encode('utf-8'))
+
+
+def run():
+    '''
+    Load the analysers and wait for the records from replay.py.
+    '''
+    epilog = '''
+examples:
+\033[1;33m/usr/bin/replay_daemon.py --socket /tmp/replay.sock --domains opendns-top-domains.txt\033[0m
+
+Keep the analysers warm for replay.py.
+'''
+    parser = argparse.ArgumentParser(description=__doc__, epilog=epilog,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    parser.add_argument('--socket', default='/tmp/replay.sock',
+                        help='the UNIX socket to listen on')
+    parser.add_argument('--domains',
+                        help='the list of domains to match with (opendns-top-domains.txt)')
+    parser.add_argument('--ac-cache',
+                        help='where to cache the Aho-Corasick automaton built from the list of domains')
+    parser.add_argument('--resume', action='store_true',
+                        help='skip the analysers whose output is already in the records')
+
+    try:
+        args = parser.parse_args()
+    # pylint: disable=broad-except
+    except Exception as error:
+        logging.error(error)
+        # some errors occur when parsing the arguments, show the usage
+        parser.print_help()
+        # then quit
+        sys.exit(1)
+
+    init_worker(args.domains, True, DomainMatchingOption.ORDER_MATCH, args.ac_cache, args.resume)
+
+    # Clean up the socket left behind by the previous run
+    if os.path.exists(args.socket):
+        os.unlink(args.socket)
+
+    # The clients are served one at a time cause they share the analysers
+    with socketserver.UnixStreamServer(args.socket, ReplayHandler) as server:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.unlink(args.socket)
+
+
+if __name__ == '__main__':
+    run()
@@ -1,12 +1,11 @@
 '''
 Apply the elliptic envelope method to separate our outliers.
 '''
-import json
 import sys
-import numpy as np
 
 from sklearn.covariance import EllipticEnvelope
-from sklearn.preprocessing import scale
+
+from samples import load_samples
 
 
 def main():
@@ -16,25 +15,10 @@ def main():
           This might be too simplistic.
         - Apply the elliptic envelope.  The contamination level is set manually.
     '''
-    domains = []
-    raw = []
-
-    with open(sys.argv[1]) as fhandle:
-        for line in fhandle:
-            record = json.loads(line.strip())
-
-            for analyser in record['analysers']:
-                if analyser['analyser'] == 'FeaturesGenerator':
-                    raw.extend(analyser['output'])
-
-                if analyser['analyser'] == 'WordSegmentation':
-                    domains.extend(analyser['output'].keys())
-
-            if len(raw) != len(domains):
-                print(record)
-                sys.exit(0)
-
-    x_samples = scale(np.array(raw))
+    domains, x_samples = load_samples(sys.argv[1])
+    if x_samples is None:
+        # There is nothing to look at
+        return
 
     engine = EllipticEnvelope(contamination=0.015, support_fraction=1.0)
     y_samples = engine.fit_predict(x_samples)
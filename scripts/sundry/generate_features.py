@@ -5,10 +5,15 @@ Generate features for outlier detection.
 import json
 import sys
 
+from certstream_analytics import codec
 from certstream_analytics.analysers import WordSegmentation
 from certstream_analytics.analysers import IDNADecoder
 from certstream_analytics.analysers import FeaturesGenerator
 
+# How many records to keep before writing them out
+OUTPUT_BATCH_SIZE = 1024
+
+
 def main(max_count=None):
     '''
     The record is assumed to be stored in a JSON file passed in as the first
@@ -18,12 +23,13 @@ def main(max_count=None):
     decoder = IDNADecoder()
     generator = FeaturesGenerator()
 
-    with open(sys.argv[1]) as fhandle:
+    with open(sys.argv[1], 'rb') as fhandle:
         count = 0
+        output = []
 
         for line in fhandle:
             try:
-                record = json.loads(line.strip())
+                record = codec.loads(line.strip())
             except json.decoder.JSONDecodeError:
                 continue
 
@@ -31,12 +37,19 @@ def main(max_count=None):
             record = segmenter.run(record)
             record = generator.run(record)
 
-            print(json.dumps(record))
+            output.append(codec.dumpline(record))
             count += 1
 
+            if len(output) >= OUTPUT_BATCH_SIZE:
+                sys.stdout.buffer.write(b''.join(output))
+                output.clear()
+
             if max_count and count > max_count:
                 break
 
+        if output:
+            sys.stdout.buffer.write(b''.join(output))
+
 
 if __name__ == '__main__':
     main()
@@ -1,12 +1,11 @@
 '''
 Apply the isolation forest method to separate our outliers.
 '''
-import json
 import sys
-import numpy as np
 
 from sklearn.ensemble import IsolationForest
-from sklearn.preprocessing import scale
+
+from samples import load_samples
 
 
 def main():
@@ -16,27 +15,13 @@ def main():
           This might be too simplistic.
         - Apply the isolation forest.  The contamination level is set manually.
     '''
-    domains = []
-    raw = []
-
-    with open(sys.argv[1]) as fhandle:
-        for line in fhandle:
-            record = json.loads(line.strip())
-
-            for analyser in record['analysers']:
-                if analyser['analyser'] == 'FeaturesGenerator':
-                    raw.extend(analyser['output'])
-
-                if analyser['analyser'] == 'WordSegmentation':
-                    domains.extend(analyser['output'].keys())
-
-            if len(raw) != len(domains):
-                print(record)
-                sys.exit(0)
-
-    x_samples = scale(np.array(raw))
+    domains, x_samples = load_samples(sys.argv[1])
+    if x_samples is None:
+        # There is nothing to look at
+        return
 
-    engine = IsolationForest(behaviour='new', contamination=0.015)
+    # Fit the trees using all the cores
+    engine = IsolationForest(n_estimators=100, contamination=0.015, n_jobs=-1, random_state=0)
     y_samples = engine.fit_predict(x_samples)
 
     for index, y_sample in enumerate(y_samples):
@@ -1,12 +1,11 @@
 '''
 Apply the local outlier factor method to separate our outliers.
 '''
-import json
 import sys
-import numpy as np
 
 from sklearn.neighbors import LocalOutlierFactor
-from sklearn.preprocessing import scale
+
+from samples import load_samples
 
 
 def main():
@@ -19,28 +18,13 @@ def main():
     This method does not seem to work in our case cause I suspect it treats groups
     of several outliers as clusters.
     '''
-    domains = []
-    raw = []
-
-    with open(sys.argv[1]) as fhandle:
-        for line in fhandle:
-            record = json.loads(line.strip())
-
-            for analyser in record['analysers']:
-                if analyser['analyser'] == 'FeaturesGenerator':
-                    raw.extend(analyser['output'])
-
-                if analyser['analyser'] == 'WordSegmentation':
-                    domains.extend(analyser['output'].keys())
-
-            if len(raw) != len(domains):
-                print(record)
-                sys.exit(0)
-
-    x_samples = scale(np.array(raw))
+    domains, x_samples = load_samples(sys.argv[1])
+    if x_samples is None:
+        # There is nothing to look at
+        return
 
     # Need to check the appropriate value for n_neighbors
-    engine = LocalOutlierFactor(contamination=0.015)
+    engine = LocalOutlierFactor(contamination=0.015, n_jobs=-1)
     y_samples = engine.fit_predict(x_samples)
 
     for index, y_sample in enumerate(y_samples):
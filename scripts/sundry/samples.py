@@ -0,0 +1,66 @@
+'''
+Load the features generated by generate_features.py for the outlier detection
+scripts.
+'''
+import numpy as np
+
+from certstream_analytics import codec
+
+
+def load_samples(path):
+    '''
+    Return the list of domains and their features, one row per domain, scaled
+    to the standard distribution with mean 0 and unit variance. The features
+    are None if there is nothing in the file.
+    '''
+    domains = []
+
+    # The feature matrix is filled in place and doubled in size whenever it's
+    # full, so that we don't need to convert a huge list of lists at the end
+    x_samples = None
+    count = 0
+
+    # The codec parses the raw bytes, there is no need to decode the lines first
+    with open(path, 'rb') as fhandle:
+        for line in fhandle:
+            record = codec.loads(line.strip())
+
+            for analyser in record['analysers']:
+                if analyser['analyser'] == 'WordSegmentation':
+                    domains.extend(analyser['output'].keys())
+
+                if analyser['analyser'] != 'FeaturesGenerator':
+                    continue
+
+                # Convert all the features of the record at once and copy
+                # them into the matrix as a block
+                features = np.asarray(analyser['output'], dtype=np.float32)
+                if not features.size:
+                    continue
+
+                if x_samples is None:
+                    x_samples = np.empty((max(1024, len(features)), features.shape[1]), dtype=np.float32)
+
+                while count + len(features) > x_samples.shape[0]:
+                    x_samples.resize((2 * x_samples.shape[0], x_samples.shape[1]), refcheck=False)
+
+                x_samples[count:count + len(features)] = features
+                count += len(features)
+
+    # Each domain has one set of features. This is checked only once at the
+    # end and can be skipped altogether with python -O
+    assert count == len(domains), 'Mismatch {} features vs {} domains'.format(count, len(domains))
+
+    if x_samples is None:
+        return domains, None
+
+    # Standardize the features in place instead of making another copy of
+    # the whole matrix
+    x_samples = x_samples[:count]
+    sigma = x_samples.std(axis=0)
+    sigma[sigma == 0] = 1
+
+    x_samples -= x_samples.mean(axis=0)
+    x_samples /= sigma
+
+    return domains, x_samples
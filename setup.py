@@ -25,13 +25,14 @@ setup(
         'wordsegment',
         'pyenchant',
         'idna',
-        'confusable_homoglyphs'
+        'confusable_homoglyphs',
+        'orjson'
     ],
     tests_require=[
         'coverage',
-        'nose',
         'pytest-pep8',
         'pytest-cov',
+        'pytest-xdist',
         'codecov'
     ],
     dependency_links=[
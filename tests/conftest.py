@@ -0,0 +1,77 @@
+'''
+Fixtures shared by all the tests. They are built once per session (or once
+per worker when the tests are run in parallel with pytest-xdist).
+'''
+import hashlib
+import os
+import pickle
+import tempfile
+
+import pytest
+
+from certstream_analytics.analysers import AhoCorasickDomainMatching
+from certstream_analytics.analysers import domain_matching
+
+
+# The mock list of common domains for testing
+DOMAIN_LIST_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'opendns-top-domains.txt')
+
+
+@pytest.fixture(scope='session')
+def top_domains():
+    '''
+    Load the mock list of common domains for testing.
+    '''
+    with open(DOMAIN_LIST_PATH, 'rb') as fhandle:
+        return fhandle.read().decode('ascii').splitlines()
+
+
+def _cache_path(cache_dir):
+    '''
+    Where the analyser is cached. The content of the list of domains and the
+    analyser's code are both part of the key so that a stale cache is never
+    used. Unlike their mtimes, the content doesn't change on a fresh checkout.
+    '''
+    digest = hashlib.blake2b(digest_size=16)
+
+    for path in (DOMAIN_LIST_PATH, domain_matching.__file__):
+        with open(path, 'rb') as fhandle:
+            digest.update(fhandle.read())
+
+    digest = digest.hexdigest()
+    return os.path.join(cache_dir, 'certstream_ac_{}.pkl'.format(digest))
+
+
+@pytest.fixture(scope='session')
+def ahocorasick_analyser(request, top_domains):
+    '''
+    Building the automaton from the list of domains takes a while, so do it
+    only once and keep it on disk for the next runs. The cache is unpickled,
+    so it's kept in the pytest cache directory of the project instead of the
+    shared temporary directory where anyone could plant it.
+    '''
+    cache = getattr(request.config, 'cache', None)
+    if cache is None:
+        # The cache provider plugin is disabled
+        return AhoCorasickDomainMatching(top_domains)
+
+    path = _cache_path(str(cache.makedir('certstream_ac')))
+
+    try:
+        with open(path, 'rb') as fhandle:
+            return pickle.load(fhandle)
+    # pylint: disable=broad-except
+    except Exception:
+        # No cache or a broken one, just build it again
+        pass
+
+    analyser = AhoCorasickDomainMatching(top_domains)
+
+    # Write to a temporary file first, so that other test workers never see
+    # a half-written cache
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), delete=False) as fhandle:
+        pickle.dump(analyser, fhandle, protocol=pickle.HIGHEST_PROTOCOL)
+
+    os.replace(fhandle.name, path)
+    return analyser
+
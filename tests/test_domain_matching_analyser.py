@@ -1,372 +1,837 @@
 '''
 Common domain matching analyser.
 '''
-import copy
-import os
+import sys
 import unittest
+from dataclasses import dataclass
+from itertools import accumulate
+from types import MappingProxyType
+from typing import Mapping
 
-from certstream_analytics.analysers import AhoCorasickDomainMatching
+import pytest
+
+from certstream_analytics.analysers import DomainParser
 from certstream_analytics.analysers import WordSegmentation
 from certstream_analytics.analysers import DomainMatching, DomainMatchingOption
 from certstream_analytics.analysers import BulkDomainMarker
 from certstream_analytics.analysers import IDNADecoder
 from certstream_analytics.analysers import HomoglyphsDecoder
+from certstream_analytics.analysers.common_domain_analyser import parse_domains
+from certstream_analytics.analysers import DomainPreprocessor
 
 
-class DomainMatchingTest(unittest.TestCase):
+def _intern_tree(obj, memo=None):
     '''
-    Test all the common domain matching analysers.
+    Intern all the strings in the test case so that the same domain shared by
+    the cases and their expected results is only kept once. The containers
+    that are shared by several cases stay shared.
     '''
-    def test_ahocorasick(self):
-        '''
-        Compare some mock domains against the list of most popular domains
-        using Aho-Corasick algorithm.
-        '''
-        # Load the mock list of common domains for testing.
-        current_dir = os.path.dirname(os.path.realpath(__file__))
+    if isinstance(obj, str):
+        return sys.intern(obj)
+
+    if memo is None:
+        memo = {}
+
+    if id(obj) in memo:
+        return memo[id(obj)]
+
+    if isinstance(obj, dict):
+        memo[id(obj)] = {_intern_tree(k, memo): _intern_tree(v, memo) for k, v in obj.items()}
+    elif isinstance(obj, (list, tuple)):
+        memo[id(obj)] = type(obj)(_intern_tree(v, memo) for v in obj)
+    else:
+        return obj
+
+    return memo[id(obj)]
+
 
-        with open(os.path.join(current_dir, 'opendns-top-domains.txt')) as fhandle:
-            domains = [line.rstrip() for line in fhandle]
+@dataclass(frozen=True)
+class Case:
+    '''
+    A test case: the record given to the analyser, what the analyser is
+    expected to return, and a short description of the case.
+    '''
+    # dataclass doesn't support slots=True in Python 3.7
+    __slots__ = ('data', 'expected', 'description')
+
+    data: Mapping
+    expected: object
+    description: str
+
+
+@dataclass(frozen=True)
+class HomoglyphsCase(Case):
+    '''
+    The homoglyphs decoder also needs to know if it should be greedy.
+    '''
+    __slots__ = ('greedy',)
+
+    greedy: bool
+
+
+def _freeze(cases, kind=Case):
+    '''
+    Turn a list of test cases into a tuple of read-only cases so that they
+    are built only once and can't be changed by the tests. The analysers add
+    their results to the record, so the tests need to copy the data before
+    running them.
+    '''
+    frozen = []
 
-        ahocorasick_analyser = AhoCorasickDomainMatching(domains)
+    for case in _intern_tree(cases):
+        frozen.append(kind(**dict(case, data=MappingProxyType(case['data']))))
 
-        cases = [
+    return tuple(frozen)
+
+
+_AHOCORASICK_CASES = _freeze([
+    {
+        'data': {
+            'all_domains': [
+                'store.google.com',
+                'google.com',
+            ],
+        },
+        'expected': [
             {
-                'data': {
-                    'all_domains': [
-                        'store.google.com',
-                        'google.com',
-                    ],
+                'analyser': 'AhoCorasickDomainMatching',
+                'output': {
+                    'store.google.com': ['google.com'],
                 },
-                'expected': [
-                    {
-                        'analyser': 'AhoCorasickDomainMatching',
-                        'output': {
-                            'store.google.com': ['google.com'],
-                        },
-                    },
-                ],
-                'description': 'An exact match domain',
             },
-
+        ],
+        'description': 'An exact match domain',
+    },
+
+    {
+        'data': {
+            'all_domains': [
+                'www.facebook.com.msg40.site',
+            ],
+        },
+        'expected': [
             {
-                'data': {
-                    'all_domains': [
-                        'www.facebook.com.msg40.site',
-                    ],
+                'analyser': 'AhoCorasickDomainMatching',
+                'output': {
+                    'www.facebook.com.msg40.site': ['facebook.com'],
                 },
-                'expected': [
-                    {
-                        'analyser': 'AhoCorasickDomainMatching',
-                        'output': {
-                            'www.facebook.com.msg40.site': ['facebook.com'],
-                        },
-                    },
-                ],
-                'description': 'A sample phishing domain with a sub-domain match',
             },
-
+        ],
+        'description': 'A sample phishing domain with a sub-domain match',
+    },
+
+    {
+        'data': {
+            'all_domains': [
+                'login-appleid.apple.com.managesuppport.co',
+            ],
+        },
+        'expected': [
             {
-                'data': {
-                    'all_domains': [
-                        'login-appleid.apple.com.managesuppport.co',
-                    ],
+                'analyser': 'AhoCorasickDomainMatching',
+                'output': {
+                    'login-appleid.apple.com.managesuppport.co': ['apple.com'],
                 },
-                'expected': [
-                    {
-                        'analyser': 'AhoCorasickDomainMatching',
-                        'output': {
-                            'login-appleid.apple.com.managesuppport.co': ['apple.com'],
-                        },
-                    },
-                ],
-                'description': 'A sample phishing domain with a partial string match',
             },
-
+        ],
+        'description': 'A sample phishing domain with a partial string match',
+    },
+
+    {
+        'data': {
+            'all_domains': [
+                'socket.io',
+            ],
+        },
+        'expected': [],
+        'description': 'A non-matching domain (not in the list of most popular domains)',
+    },
+
+    {
+        'data': {
+            'all_domains': [
+                'www.foobar2000.com',
+            ],
+        },
+        'expected': [],
+        'description': 'A non-matching domain (excluded pattern)',
+    },
+
+    {
+        'data': {
+            'all_domains': [
+                'autodiscover.blablabla.com',
+            ],
+        },
+        'expected': [],
+        'description': 'Match a ignored pattern',
+    },
+])
+
+
+_WORDSEG_CASES = _freeze([
+    {
+        'data': {
+            'all_domains': [
+                'store.google.com',
+                'google.com',
+            ],
+        },
+        'expected': [
             {
-                'data': {
-                    'all_domains': [
-                        'socket.io',
-                    ],
+                'analyser': 'WordSegmentation',
+                'output': {
+                    'store.google.com': ['store', 'google', 'com'],
+                    'google.com': ['google', 'com'],
                 },
-                'expected': [],
-                'description': 'A non-matching domain (not in the list of most popular domains)',
             },
-
+        ],
+        'description': 'A legit domain',
+    },
+
+    {
+        'data': {
+            'all_domains': [
+                'www.facebook.com.msg40.site',
+            ],
+        },
+        'expected': [
             {
-                'data': {
-                    'all_domains': [
-                        'www.foobar2000.com',
-                    ],
+                'analyser': 'WordSegmentation',
+                'output': {
+                    'www.facebook.com.msg40.site': ['www', 'facebook', 'com', 'msg40', 'site'],
                 },
-                'expected': [],
-                'description': 'A non-matching domain (excluded pattern)',
             },
-
+        ],
+        'description': 'Word segmentation using the domain separator (dot)',
+    },
+
+    {
+        'data': {
+            'all_domains': [
+                'login-appleid.apple.com.managesuppport.co',
+            ],
+        },
+        'expected': [
             {
-                'data': {
-                    'all_domains': [
-                        'autodiscover.blablabla.com',
+                'analyser': 'WordSegmentation',
+                'output': {
+                    'login-appleid.apple.com.managesuppport.co': [
+                        'login',
+                        'apple',
+                        'id',
+                        'apple',
+                        'com',
+                        'manage',
+                        'suppport',
+                        'co'
                     ],
                 },
-                'expected': [],
-                'description': 'Match a ignored pattern',
             },
-        ]
-
-        for case in cases:
-            got = ahocorasick_analyser.run(case['data'])
-            self.assertListEqual(got['analysers'], case['expected'], case['description'])
-
-    def test_wordsegmentation(self):
-        '''
-        Try to segment some domains and check the result.
-        '''
-        wordsegmentation = WordSegmentation()
-
-        cases = [
+        ],
+        'description': 'Word segmentation using dictionary',
+    },
+
+    {
+        'data': {
+            'all_domains': [
+                'arch.mappleonline.com',
+            ],
+        },
+        'expected': [
             {
-                'data': {
-                    'all_domains': [
-                        'store.google.com',
-                        'google.com',
-                    ],
+                'analyser': 'WordSegmentation',
+                'output': {
+                    'arch.mappleonline.com': ['arch', 'm', 'apple', 'online', 'com'],
                 },
-                'expected': [
-                    {
-                        'analyser': 'WordSegmentation',
-                        'output': {
-                            'store.google.com': ['store', 'google', 'com'],
-                            'google.com': ['google', 'com'],
-                        },
-                    },
-                ],
-                'description': 'A legit domain',
             },
-
+        ],
+        'description': 'Failed to segment the word correctly',
+    },
+
+    {
+        'data': {
+            'all_domains': [
+                'www.freybrothersinc.com',
+            ],
+        },
+        'expected': [
             {
-                'data': {
-                    'all_domains': [
-                        'www.facebook.com.msg40.site',
-                    ],
+                'analyser': 'WordSegmentation',
+                'output': {
+                    'www.freybrothersinc.com': ['www', 'frey', 'brothers', 'com'],
                 },
-                'expected': [
-                    {
-                        'analyser': 'WordSegmentation',
-                        'output': {
-                            'www.facebook.com.msg40.site': ['www', 'facebook', 'com', 'msg40', 'site'],
-                        },
-                    },
-                ],
-                'description': 'Word segmentation using the domain separator (dot)',
             },
-
+        ],
+        'description': 'Ignore certain stop words (inc) when doing segmentation',
+    },
+])
+
+
+_DOMAIN_PARSER_CASES = _freeze([
+    {
+        'data': {
+            'all_domains': [
+                'store.google.com',
+                '*.google.co.uk',
+            ],
+        },
+        'expected': [
             {
-                'data': {
-                    'all_domains': [
-                        'login-appleid.apple.com.managesuppport.co',
-                    ],
-                },
-                'expected': [
-                    {
-                        'analyser': 'WordSegmentation',
-                        'output': {
-                            'login-appleid.apple.com.managesuppport.co': [
-                                'login',
-                                'apple',
-                                'id',
-                                'apple',
-                                'com',
-                                'manage',
-                                'suppport',
-                                'co'
-                            ],
-                        },
-                    },
-                ],
-                'description': 'Word segmentation using dictionary',
+                'raw': 'store.google.com',
+                'name': 'store.google.com',
+                'sub': 'store',
+                'dom': 'google',
+                'tld': 'com',
+                'joined': 'store.google',
             },
-
             {
-                'data': {
-                    'all_domains': [
-                        'arch.mappleonline.com',
-                    ],
+                'raw': '*.google.co.uk',
+                'name': 'google.co.uk',
+                'sub': '',
+                'dom': 'google',
+                'tld': 'co.uk',
+                'joined': 'google',
+            },
+        ],
+        'description': 'Parse a normal domain and a wildcard domain',
+    },
+])
+
+
+# The same match is expected from several options
+_APPLE_MATCH = {
+    'analyser': 'DomainMatching',
+    'output': {
+        'login-appleid.managesuppport.com': ['apple.com']
+    },
+}
+
+_DOMAIN_MATCHING_CASES = _freeze([
+    {
+        'data': {
+            'all_domains': [
+                'store.google.com',
+                'google.com',
+            ],
+
+            'analysers': [
+                {
+                    'analyser': 'AhoCorasickDomainMatching',
+                    'output': {
+                        'store.google.com': ['google.com'],
+                    },
                 },
-                'expected': [
-                    {
-                        'analyser': 'WordSegmentation',
-                        'output': {
-                            'arch.mappleonline.com': ['arch', 'm', 'apple', 'online', 'com'],
-                        },
+
+                {
+                    'analyser': 'WordSegmentation',
+                    'output': {
+                        'store.google.com': ['store', 'google', 'com'],
+                        'google.com': ['google', 'com'],
                     },
-                ],
-                'description': 'Failed to segment the word correctly',
-            },
+                },
+            ],
+        },
+        'expected': {
+            (True, DomainMatchingOption.SUBSET_MATCH): [],
+            (False, DomainMatchingOption.SUBSET_MATCH): [],
+            (True, DomainMatchingOption.ORDER_MATCH): [],
+            (False, DomainMatchingOption.ORDER_MATCH): [],
+        },
+        'description': 'A legit domain so it will be skipped (no match reported)',
+    },
+
+    {
+        'data': {
+            'all_domains': [
+                'login-appleid.managesuppport.com',
+            ],
+
+            'analysers': [
+                {
+                    'analyser': 'AhoCorasickDomainMatching',
+                    'output': {
+                        'login-appleid.managesuppport.com': ['apple.com'],
+                    },
+                },
 
-            {
-                'data': {
-                    'all_domains': [
-                        'www.freybrothersinc.com',
-                    ],
+                {
+                    'analyser': 'WordSegmentation',
+                    'output': {
+                        'login-appleid.managesuppport.com': [
+                            'login',
+                            'apple',
+                            'id',
+                            'manage',
+                            'suppport'
+                        ],
+                    },
                 },
-                'expected': [
-                    {
-                        'analyser': 'WordSegmentation',
-                        'output': {
-                            'www.freybrothersinc.com': ['www', 'frey', 'brothers', 'com'],
-                        },
+            ],
+        },
+        'expected': {
+            (True, DomainMatchingOption.SUBSET_MATCH): [],
+            (False, DomainMatchingOption.SUBSET_MATCH): [_APPLE_MATCH],
+            (True, DomainMatchingOption.ORDER_MATCH): [],
+            (False, DomainMatchingOption.ORDER_MATCH): [_APPLE_MATCH],
+        },
+        'description': 'Find a matching phishing domain',
+    },
+
+    {
+        'data': {
+            'all_domains': [
+                'djunprotected.com',
+                'www.djunprotected.com'
+            ],
+
+            'analysers': [
+                {
+                    'analyser': 'AhoCorasickDomainMatching',
+                    'output': {
+                        'djunprotected.com': ['ted.com']
+                    }
+                },
+
+                {
+                    'analyser': 'WordSegmentation',
+                    'output': {
+                        'djunprotected.com': ['dj', 'unprotected', 'com'],
+                        'www.djunprotected.com': ['www', 'dj', 'unprotected', 'com']
+                    }
+                },
+            ],
+        },
+        'expected': {
+            (True, DomainMatchingOption.SUBSET_MATCH): [],
+            (False, DomainMatchingOption.SUBSET_MATCH): [],
+            (True, DomainMatchingOption.ORDER_MATCH): [],
+            (False, DomainMatchingOption.ORDER_MATCH): [],
+        },
+        'description': 'Find a matching phishing domain',
+    },
+])
+
+
+# The first option decides if the TLD is included in the match
+_DOMAIN_MATCHING_OPTIONS = (
+    (True, DomainMatchingOption.SUBSET_MATCH),
+    (False, DomainMatchingOption.SUBSET_MATCH),
+    (True, DomainMatchingOption.ORDER_MATCH),
+    (False, DomainMatchingOption.ORDER_MATCH),
+)
+
+
+def _domain_matching_runs():
+    '''
+    Work out the list of analysers each case is expected to end up with for
+    each option. The options don't make any difference to some cases, so that
+    list is built only once and shared by all the options. Every option still
+    runs every case.
+    '''
+    runs = {option: [] for option in _DOMAIN_MATCHING_OPTIONS}
+
+    for case in _DOMAIN_MATCHING_CASES:
+        if len({repr(v) for v in case.expected.values()}) == 1:
+            shared = case.data['analysers'] + case.expected[_DOMAIN_MATCHING_OPTIONS[0]]
+            expected = dict.fromkeys(_DOMAIN_MATCHING_OPTIONS, shared)
+        else:
+            expected = {o: case.data['analysers'] + case.expected[o] for o in _DOMAIN_MATCHING_OPTIONS}
+
+        for option in _DOMAIN_MATCHING_OPTIONS:
+            runs[option].append((case, expected[option]))
+
+    return {option: tuple(run) for option, run in runs.items()}
+
+
+_DOMAIN_MATCHING_RUNS = _domain_matching_runs()
+
+
+_BULK_DOMAIN_CASES = _freeze([
+    {
+        'data': {
+            'all_domains': [
+                'store.google.com',
+                'google.com',
+            ],
+        },
+        'expected':  [
+            {'analyser': 'BulkDomainMarker', 'output': False}
+        ],
+        'description': 'Not a bulk record',
+    },
+    {
+        'data': {
+            'all_domains': [
+                'a.com',
+                'b.com',
+                'c.com',
+                'd.com',
+                'e.com',
+                'f.com',
+                'g.com',
+                'h.com',
+                'i.com',
+                'j.com',
+                'k.com',
+                'l.com',
+                'm.com',
+                'n.com',
+                'o.com',
+            ],
+        },
+        'expected':  [
+            {'analyser': 'BulkDomainMarker', 'output': True}
+        ],
+        'description': 'Mark a bulk record',
+    },
+])
+
+
+_IDNA_CASES = _freeze([
+    {
+        'data': {
+            'all_domains': [
+                'store.google.com',
+                'google.com',
+            ],
+        },
+        'expected':  [
+            'store.google.com',
+            'google.com',
+        ],
+        'description': 'There is no domain in IDNA format',
+    },
+    {
+        'data': {
+            'all_domains': [
+                'xn--f1ahbgpekke1h.xn--p1ai',
+                'tigrobaldai.lt'
+            ],
+        },
+        'expected':  [
+            'укрэмпужск.рф',
+            'tigrobaldai.lt'
+        ],
+        'description': 'Convert some domains in IDNA format',
+    },
+    {
+        'data': {
+            'all_domains': [
+                'xn--foobar.xn--me',
+            ],
+        },
+        'expected':  [
+            'xn--foobar.xn--me',
+        ],
+        'description': 'Handle an invalid IDNA string',
+    },
+    {
+        'data': {
+            'all_domains': [
+                '*.xn---35-5cd3cln6a9bzb.xn--p1ai',
+                '*.nl-dating-vidkid.com',
+            ],
+        },
+        'expected':  [
+            '*.отмычка-35.рф',
+            '*.nl-dating-vidkid.com',
+        ],
+        'description': 'Handle an invalid code point',
+    },
+])
+
+
+_HOMOGLYPHS_CASES = _freeze(kind=HomoglyphsCase, cases=[
+    {
+        'data': {
+            'all_domains': [
+                'store.google.com',
+                '*.google.com',
+            ],
+        },
+        'greedy': False,
+        'expected':  [
+            'store.google.com',
+            '*.google.com',
+        ],
+        'description': 'Normal domains in ASCII',
+    },
+    {
+        'data': {
+            'all_domains': [
+                'store.google.com',
+                '*.google.com',
+            ],
+        },
+        'greedy': True,
+        'expected':  [
+            'store.google.com',
+            'store.google.corn',
+            'store.googie.com',
+            'store.googie.corn',
+            '*.google.com',
+            '*.google.corn',
+            '*.googie.com',
+            '*.googie.corn'
+        ],
+        'description': 'Normal domains in ASCII with a greedy decoder',
+    },
+    {
+        'data': {
+            'all_domains': [
+                'укрэмпужск.рф',
+                'tigrobaldai.lt',
+            ],
+        },
+        'greedy': False,
+        'expected':  [
+            'yкpэмпyжcк.pф',
+            'tigrobaldai.lt',
+        ],
+        'description': 'Normal domains in Unicode',
+    },
+    {
+        'data': {
+            'all_domains': [
+                'укрэмпужск.рф',
+                'tigrobaldai.lt',
+            ],
+        },
+        'greedy': True,
+        'expected':  [
+            'yкpэмпyжcк.pф',
+            'tigrobaldai.lt',
+            'tigrobaldai.it',
+            'tigrobaidai.lt',
+            'tigrobaidai.it',
+        ],
+        'description': 'Normal domains in Unicode with a greedy decoder',
+    },
+    {
+        'data': {
+            'all_domains': [
+                # MATHEMATICAL MONOSPACE SMALL P 1D699
+                '*.𝗉aypal.com',
+
+                # MATHEMATICAL SAN-SERIF BOLD SMALL RHO
+                'phishing.𝗉ay𝞀al.com',
+            ],
+        },
+        'greedy': False,
+        'expected': [
+            '*.paypal.com',
+            'phishing.paypal.com',
+        ],
+        'description': 'Phishing example in confusable homoglyphs'
+    },
+    {
+        'data': {
+            'all_domains': [
+                # MATHEMATICAL MONOSPACE SMALL P 1D699
+                '*.𝗉aypal.com',
+
+                # MATHEMATICAL SAN-SERIF BOLD SMALL RHO
+                'phishing.𝗉ay𝞀al.com',
+            ],
+        },
+        'greedy': True,
+        'expected': [
+            '*.paypal.com',
+            '*.paypal.corn',
+            '*.paypai.com',
+            '*.paypai.corn',
+            'phishing.paypal.com',
+            'phishing.paypal.corn',
+            'phishing.paypai.com',
+            'phishing.paypai.corn',
+        ],
+        'description': 'Phishing example in confusable homoglyphs with a greedy decoder'
+    },
+])
+
+
+# The expected results come from running the analysers one after another
+_PREPROCESSOR_CASES = _freeze([
+    {
+        'data': {
+            'all_domains': [
+                'store.google.com',
+                '*.google.co.uk',
+            ],
+        },
+        'expected': {
+            'all_domains': [
+                'store.google.com',
+                '*.google.co.uk',
+            ],
+            'analysers': [
+                {
+                    'analyser': 'WordSegmentation',
+                    'output': {
+                        'store.google.com': ['store', 'google', 'com'],
+                        'google.co.uk': ['google', 'co', 'uk'],
                     },
-                ],
-                'description': 'Ignore certain stop words (inc) when doing segmentation',
-            },
-        ]
+                },
+            ],
+        },
+        'description': 'Normal domains are only segmented',
+    },
+    {
+        'data': {
+            'all_domains': [
+                'xn--80ak6aa92e.com',
+                'phishing.𝗉ay𝞀al.com',
+            ],
+        },
+        'expected': {
+            'all_domains': [
+                'appie.com',
+                'phishing.paypal.com',
+            ],
+            'analysers': [
+                {
+                    'analyser': 'WordSegmentation',
+                    'output': {
+                        'appie.com': ['ie', 'com'],
+                        'phishing.paypal.com': ['phishing', 'paypal', 'com'],
+                    },
+                },
+            ],
+        },
+        'description': 'IDNA and homoglyph domains are decoded before being segmented',
+    },
+])
 
-        for case in cases:
-            got = wordsegmentation.run(case['data'])
-            self.assertListEqual(got['analysers'], case['expected'], case['description'])
 
-    def test_domain_matching(self):
+class DomainMatchingTest(unittest.TestCase):
+    '''
+    Test all the common domain matching analysers.
+    '''
+    @classmethod
+    def setUpClass(cls):
         '''
-        Combine the result of all domain matching analysers into one.
+        Build the analysers once for all the tests cause loading the wordsegment
+        package takes a while.
         '''
-        # The first option decides if the TLD is included in the match
-        options = [
-            (True, DomainMatchingOption.SUBSET_MATCH),
-            (False, DomainMatchingOption.SUBSET_MATCH),
-            (True, DomainMatchingOption.ORDER_MATCH),
-            (False, DomainMatchingOption.ORDER_MATCH),
-        ]
+        cls.wordsegmentation = WordSegmentation()
+        # Run it once so that the first test doesn't pay for any lazy setup
+        cls.wordsegmentation.run({'all_domains': ['google.com']})
 
-        analysers = {o: DomainMatching(include_tld=o[0], option=o[1]) for o in options}
+        cls.domain_matching_analysers = {o: DomainMatching(include_tld=o[0], option=o[1])
+                                         for o in _DOMAIN_MATCHING_OPTIONS}
+        cls.homoglyphs_decoders = {greedy: HomoglyphsDecoder(greedy=greedy) for greedy in (False, True)}
 
-        cases = [
-            {
-                'data': {
-                    'all_domains': [
-                        'store.google.com',
-                        'google.com',
-                    ],
+    @pytest.fixture(autouse=True)
+    def _ahocorasick_analyser(self, ahocorasick_analyser):
+        '''
+        Building the Aho-Corasick analyser takes a while, so it's shared by the
+        whole session (see conftest.py).
+        '''
+        self.ahocorasick_analyser = ahocorasick_analyser
 
-                    'analysers': [
-                        {
-                            'analyser': 'AhoCorasickDomainMatching',
-                            'output': {
-                                'store.google.com': ['google.com'],
-                            },
-                        },
-
-                        {
-                            'analyser': 'WordSegmentation',
-                            'output': {
-                                'store.google.com': ['store', 'google', 'com'],
-                                'google.com': ['google', 'com'],
-                            },
-                        },
-                    ],
-                },
-                'expected': {
-                    (True, DomainMatchingOption.SUBSET_MATCH): [],
-                    (False, DomainMatchingOption.SUBSET_MATCH): [],
-                    (True, DomainMatchingOption.ORDER_MATCH): [],
-                    (False, DomainMatchingOption.ORDER_MATCH): [],
-                },
-                'description': 'A legit domain so it will be skipped (no match reported)',
-            },
+    def assertOneEqual(self, got, expected):
+        '''
+        Aho-Corasick reports at most one result per record, so compare that result
+        (or its absence) directly instead of the whole list.
+        '''
+        # pylint: disable=invalid-name
+        self.assertLessEqual(len(got), 1, 'At most one result is reported')
+        self.assertEqual(got[0] if got else None, expected[0] if expected else None)
 
-            {
-                'data': {
-                    'all_domains': [
-                        'login-appleid.managesuppport.com',
-                    ],
+    def assertBatchEqual(self, got, expected, descriptions):
+        '''
+        Compare all the results in one go with a plain ==, which doesn't care
+        about the order of the keys in a dict either. Only when they don't
+        match, the cases are checked one by one, each in its own subTest, to
+        find out which ones fail and get a readable diff.
+        '''
+        # pylint: disable=invalid-name
+        self.assertEqual(len(got), len(expected))
 
-                    'analysers': [
-                        {
-                            'analyser': 'AhoCorasickDomainMatching',
-                            'output': {
-                                'login-appleid.managesuppport.com': ['apple.com'],
-                            },
-                        },
-
-                        {
-                            'analyser': 'WordSegmentation',
-                            'output': {
-                                'login-appleid.managesuppport.com': [
-                                    'login',
-                                    'apple',
-                                    'id',
-                                    'manage',
-                                    'suppport'
-                                ],
-                            },
-                        },
-                    ],
-                },
-                'expected': {
-                    (True, DomainMatchingOption.SUBSET_MATCH): [],
-                    (False, DomainMatchingOption.SUBSET_MATCH): [
-                        {
-                            'analyser': 'DomainMatching',
-                            'output': {
-                                'login-appleid.managesuppport.com': ['apple.com']
-                            },
-                        },
-                    ],
-                    (True, DomainMatchingOption.ORDER_MATCH): [],
-                    (False, DomainMatchingOption.ORDER_MATCH): [
-                        {
-                            'analyser': 'DomainMatching',
-                            'output': {
-                                'login-appleid.managesuppport.com': ['apple.com']
-                            },
-                        },
-                    ],
-                },
-                'description': 'Find a matching phishing domain',
-            },
+        if list(got) == list(expected):
+            return
 
-            {
-                'data': {
-                    'all_domains': [
-                        'djunprotected.com',
-                        'www.djunprotected.com'
-                    ],
+        for got_one, expected_one, description in zip(got, expected, descriptions):
+            with self.subTest(description=description):
+                self.assertEqual(got_one, expected_one)
 
-                    'analysers': [
-                        {
-                            'analyser': 'AhoCorasickDomainMatching',
-                            'output': {
-                                'djunprotected.com': ['ted.com']
-                            }
-                        },
-
-                        {
-                            'analyser': 'WordSegmentation',
-                            'output': {
-                                'djunprotected.com': ['dj', 'unprotected', 'com'],
-                                'www.djunprotected.com': ['www', 'dj', 'unprotected', 'com']
-                            }
-                        },
-                    ],
-                },
-                'expected': {
-                    (True, DomainMatchingOption.SUBSET_MATCH): [],
-                    (False, DomainMatchingOption.SUBSET_MATCH): [],
-                    (True, DomainMatchingOption.ORDER_MATCH): [],
-                    (False, DomainMatchingOption.ORDER_MATCH): [],
-                },
-                'description': 'Find a matching phishing domain',
-            },
-        ]
+    def test_ahocorasick(self):
+        '''
+        Compare some mock domains against the list of most popular domains
+        using Aho-Corasick algorithm.
+        '''
+        for case in _AHOCORASICK_CASES:
+            with self.subTest(description=case.description):
+                got = self.ahocorasick_analyser.run(dict(case.data))
+                self.assertOneEqual(got['analysers'], case.expected)
+
+    def test_ahocorasick_batch(self):
+        '''
+        Matching all the cases in one batch gives the same result.
+        '''
+        cases = _AHOCORASICK_CASES
 
-        for case in cases:
-            for option, analyser in analysers.items():
-                expected = copy.deepcopy(case['data']['analysers'])
-                expected.extend(case['expected'][option])
+        batch = self.ahocorasick_analyser.run_batch([dict(case.data) for case in cases])
 
-                got = analyser.run(case['data'])
-                self.assertListEqual(got['analysers'], expected,
-                                     '{} ({})'.format(case['description'], option))
+        self.assertBatchEqual([got['analysers'] for got in batch],
+                              [case.expected for case in cases],
+                              [case.description for case in cases])
+
+    def test_ahocorasick_has_match(self):
+        '''
+        The quick check used to filter out raw records.
+        '''
+        self.assertTrue(self.ahocorasick_analyser.has_match('{"all_domains": ["store.google.com"]}'))
+        self.assertFalse(self.ahocorasick_analyser.has_match('{"all_domains": ["socket.io"]}'))
+
+    def test_wordsegmentation(self):
+        '''
+        Try to segment some domains and check the result.
+        '''
+        wordsegmentation = self.wordsegmentation
+
+        cases = _WORDSEG_CASES
+
+        batch = wordsegmentation.run_batch([dict(case.data) for case in cases])
+
+        self.assertBatchEqual([got['analysers'] for got in batch],
+                              [case.expected for case in cases],
+                              [case.description for case in cases])
+
+    def test_domain_parser(self):
+        '''
+        Parse the domains once so that other analysers can reuse the result.
+        '''
+        parser = DomainParser()
+
+        cases = _DOMAIN_PARSER_CASES
+
+        batch = parser.run_batch([dict(case.data) for case in cases])
+
+        # The parsed domains are kept in the cache, not in the record
+        self.assertFalse([got for got in batch if 'parsed_domains' in got])
+        self.assertBatchEqual([parse_domains(got) for got in batch],
+                              [case.expected for case in cases],
+                              [case.description for case in cases])
+
+    def test_domain_matching(self):
+        '''
+        Combine the result of all domain matching analysers into one.
+        '''
+        for option, analyser in self.domain_matching_analysers.items():
+            runs = _DOMAIN_MATCHING_RUNS[option]
+
+            # The analyser appends its result to the list of analysers, so give
+            # it a fresh list each time
+            batch = analyser.run_batch([{
+                'all_domains': case.data['all_domains'],
+                'analysers': list(case.data['analysers']),
+            } for case, _ in runs])
+
+            self.assertBatchEqual([got['analysers'] for got in batch],
+                                  [expected for _, expected in runs],
+                                  ['{} ({})'.format(case.description, option) for case, _ in runs])
 
     def test_bulk_domain_marker(self):
         '''
@@ -374,49 +839,13 @@ class DomainMatchingTest(unittest.TestCase):
         '''
         bulky = BulkDomainMarker()
 
-        cases = [
-            {
-                'data': {
-                    'all_domains': [
-                        'store.google.com',
-                        'google.com',
-                    ],
-                },
-                'expected':  [
-                    {'analyser': 'BulkDomainMarker', 'output': False}
-                ],
-                'description': 'Not a bulk record',
-            },
-            {
-                'data': {
-                    'all_domains': [
-                        'a.com',
-                        'b.com',
-                        'c.com',
-                        'd.com',
-                        'e.com',
-                        'f.com',
-                        'g.com',
-                        'h.com',
-                        'i.com',
-                        'j.com',
-                        'k.com',
-                        'l.com',
-                        'm.com',
-                        'n.com',
-                        'o.com',
-                    ],
-                },
-                'expected':  [
-                    {'analyser': 'BulkDomainMarker', 'output': True}
-                ],
-                'description': 'Mark a bulk record',
-            },
-        ]
+        cases = _BULK_DOMAIN_CASES
 
-        for case in cases:
-            got = bulky.run(case['data'])
-            self.assertListEqual(got['analysers'], case['expected'], case['description'])
+        batch = bulky.run_batch([dict(case.data) for case in cases])
+
+        self.assertBatchEqual([got['analysers'] for got in batch],
+                              [case.expected for case in cases],
+                              [case.description for case in cases])
 
     def test_idn_decoder(self):
         '''
@@ -424,177 +853,42 @@ class DomainMatchingTest(unittest.TestCase):
         '''
         decoder = IDNADecoder()
 
-        cases = [
-            {
-                'data': {
-                    'all_domains': [
-                        'store.google.com',
-                        'google.com',
-                    ],
-                },
-                'expected':  [
-                    'store.google.com',
-                    'google.com',
-                ],
-                'description': 'There is no domain in IDNA format',
-            },
-            {
-                'data': {
-                    'all_domains': [
-                        'xn--f1ahbgpekke1h.xn--p1ai',
-                        'tigrobaldai.lt'
-                    ],
-                },
-                'expected':  [
-                    'укрэмпужск.рф',
-                    'tigrobaldai.lt'
-                ],
-                'description': 'Convert some domains in IDNA format',
-            },
-            {
-                'data': {
-                    'all_domains': [
-                        'xn--foobar.xn--me',
-                    ],
-                },
-                'expected':  [
-                    'xn--foobar.xn--me',
-                ],
-                'description': 'Handle an invalid IDNA string',
-            },
-            {
-                'data': {
-                    'all_domains': [
-                        '*.xn---35-5cd3cln6a9bzb.xn--p1ai',
-                        '*.nl-dating-vidkid.com',
-                    ],
-                },
-                'expected':  [
-                    '*.отмычка-35.рф',
-                    '*.nl-dating-vidkid.com',
-                ],
-                'description': 'Handle an invalid code point',
-            },
-        ]
+        cases = _IDNA_CASES
 
-        for case in cases:
-            got = decoder.run(case['data'])
-            self.assertListEqual(got['all_domains'], case['expected'], case['description'])
+        # Decode the domains of all the cases in one record, the order of the
+        # domains is kept so the result can be split back by case
+        got = decoder.run({'all_domains': [d for case in cases for d in case.data['all_domains']]})
+
+        ends = list(accumulate(len(case.data['all_domains']) for case in cases))
+        starts = [0] + ends[:-1]
+
+        self.assertBatchEqual([got['all_domains'][start:end] for start, end in zip(starts, ends)],
+                              [case.expected for case in cases],
+                              [case.description for case in cases])
 
     def test_homoglyphs_decoder(self):
         '''
         Test the homoglyphs decoder.
         '''
-        cases = [
-            {
-                'data': {
-                    'all_domains': [
-                        'store.google.com',
-                        '*.google.com',
-                    ],
-                },
-                'greedy': False,
-                'expected':  [
-                    'store.google.com',
-                    '*.google.com',
-                ],
-                'description': 'Normal domains in ASCII',
-            },
-            {
-                'data': {
-                    'all_domains': [
-                        'store.google.com',
-                        '*.google.com',
-                    ],
-                },
-                'greedy': True,
-                'expected':  [
-                    'store.google.com',
-                    'store.google.corn',
-                    'store.googie.com',
-                    'store.googie.corn',
-                    '*.google.com',
-                    '*.google.corn',
-                    '*.googie.com',
-                    '*.googie.corn'
-                ],
-                'description': 'Normal domains in ASCII with a greedy decoder',
-            },
-            {
-                'data': {
-                    'all_domains': [
-                        'укрэмпужск.рф',
-                        'tigrobaldai.lt',
-                    ],
-                },
-                'greedy': False,
-                'expected':  [
-                    'yкpэмпyжcк.pф',
-                    'tigrobaldai.lt',
-                ],
-                'description': 'Normal domains in Unicode',
-            },
-            {
-                'data': {
-                    'all_domains': [
-                        'укрэмпужск.рф',
-                        'tigrobaldai.lt',
-                    ],
-                },
-                'greedy': True,
-                'expected':  [
-                    'yкpэмпyжcк.pф',
-                    'tigrobaldai.lt',
-                    'tigrobaldai.it',
-                    'tigrobaidai.lt',
-                    'tigrobaidai.it',
-                ],
-                'description': 'Normal domains in Unicode with a greedy decoder',
-            },
-            {
-                'data': {
-                    'all_domains': [
-                        # MATHEMATICAL MONOSPACE SMALL P 1D699
-                        '*.𝗉aypal.com',
+        cases = _HOMOGLYPHS_CASES
 
-                        # MATHEMATICAL SAN-SERIF BOLD SMALL RHO
-                        'phishing.𝗉ay𝞀al.com',
-                    ],
-                },
-                'greedy': False,
-                'expected': [
-                    '*.paypal.com',
-                    'phishing.paypal.com',
-                ],
-                'description': 'Phishing example in confusable homoglyphs'
-            },
-            {
-                'data': {
-                    'all_domains': [
-                        # MATHEMATICAL MONOSPACE SMALL P 1D699
-                        '*.𝗉aypal.com',
+        got = [self.homoglyphs_decoders[case.greedy].run(dict(case.data))['all_domains'] for case in cases]
 
-                        # MATHEMATICAL SAN-SERIF BOLD SMALL RHO
-                        'phishing.𝗉ay𝞀al.com',
-                    ],
-                },
-                'greedy': True,
-                'expected': [
-                    '*.paypal.com',
-                    '*.paypal.corn',
-                    '*.paypai.com',
-                    '*.paypai.corn',
-                    'phishing.paypal.com',
-                    'phishing.paypal.corn',
-                    'phishing.paypai.com',
-                    'phishing.paypai.corn',
-                ],
-                'description': 'Phishing example in confusable homoglyphs with a greedy decoder'
-            },
-        ]
+        self.assertBatchEqual(got,
+                              [case.expected for case in cases],
+                              [case.description for case in cases])
+
+    def test_domain_preprocessor(self):
+        '''
+        Decode, parse, and segment the domains in one pass.
+        '''
+        cases = _PREPROCESSOR_CASES
+
+        preprocessor = DomainPreprocessor(greedy=False)
 
-        for case in cases:
-            decoder = HomoglyphsDecoder(greedy=case['greedy'])
+        # The preprocessor replaces the list of domains instead of changing it
+        batch = preprocessor.run_batch([dict(case.data) for case in cases])
 
-            got = decoder.run(case['data'])
-            self.assertListEqual(got['all_domains'], case['expected'], case['description'])
+        self.assertBatchEqual(batch,
+                              [case.expected for case in cases],
+                              [case.description for case in cases])
@@ -2,21 +2,32 @@
 Save some dummy records into Elasticsearch.
 '''
 import os
-import json
-import time
 import unittest
 
 from elasticsearch import Elasticsearch
 from elasticsearch_dsl import Search, Q
 
+from certstream_analytics import codec
 from certstream_analytics.transformers import CertstreamTransformer
 from certstream_analytics.storages import ElasticsearchStorage
 
 
+# Some sample records from certstream
+SAMPLES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'samples.json')
+
+
 class ElasticsearchTest(unittest.TestCase):
     '''
     Test the way we save data into Elasticsearch.
     '''
+    @classmethod
+    def setUpClass(cls):
+        '''
+        Load the sample records only once.
+        '''
+        with open(SAMPLES_PATH, 'rb') as fhandle:
+            cls.samples = codec.loads(fhandle.read())
+
     def setUp(self):
         '''
         Setup the client to consume from certstream and save the data into
@@ -32,26 +43,21 @@ class ElasticsearchTest(unittest.TestCase):
         '''
         Start to save certstream data into Elasticsearch.
         '''
-        current_dir = os.path.dirname(os.path.realpath(__file__))
-
-        with open(os.path.join(current_dir, 'samples.json')) as fhandle:
-            samples = json.load(fhandle)
+        samples = self.samples
 
-        for sample in samples:
-            filtered = self.transformer.apply(sample)
-            self.storage.save(filtered)
+        # Index all the samples in one go and wait until they are searchable
+        self.storage.save_many([self.transformer.apply(sample) for sample in samples],
+                               refresh='wait_for')
 
-        # Try to wait for a few seconds here so that Elasticsearch has enough
-        # time to index the data
-        time.sleep(5)
+        domains = {sample['data']['leaf_cert']['all_domains'][0] for sample in samples}
 
-        for sample in samples:
-            domain = sample['data']['leaf_cert']['all_domains'][0]
-            # Look for the record in Elasticsearch
-            query = Q('multi_match', query=domain, fields=['domain', 'san'])
-            response = self.search.query(query).execute()
+        # Look for all the records in Elasticsearch with a single query. The
+        # same domain could have been indexed more than once, so only the list
+        # of distinct matching domains is returned
+        search = self.search.filter(Q('terms', **{'domain.raw': list(domains)})).extra(size=0)
+        search.aggs.bucket('domains', 'terms', field='domain.raw', size=len(domains))
+        response = search.execute()
 
-            self.assertGreaterEqual(response.hits.total, 1,
-                                    'The record has been indexed in Elasticsearch')
-            self.assertIn(response.hits[0].domain, sample['data']['leaf_cert']['all_domains'],
-                          'The correct record is returned')
+        found = {bucket.key for bucket in response.aggregations.domains.buckets}
+        for domain in domains:
+            self.assertIn(domain, found, 'The record has been indexed in Elasticsearch')
@@ -1,13 +1,66 @@
 '''
 Various tests for the reporter module.
 '''
+import atexit
 import json
+import os
 import tempfile
 import unittest
 
 from certstream_analytics.reporters import FileReporter
 
 
+# All reports are only read by the test
+_REPORT_CASES = (
+    {
+        'report': {
+            'all_domains': ['store.google.com', 'google.com'],
+            'analysers': [
+                {
+                    'analyser': 'AhoCorasickDomainMatching',
+                    'domain': 'store.google.com',
+                    'match': 'google',
+                },
+            ],
+        },
+        'description': 'Report an exact match domain',
+    },
+
+    {
+        'report': {
+            'all_domains': ['www.facebook.com.msg40.site'],
+            'analysers': [
+                {
+                    'analyser': 'AhoCorasickDomainMatching',
+                    'domain': 'www.facebook.com.msg40.site',
+                    'match': 'facebook',
+                },
+            ],
+        },
+        'description': 'Report a phishing domain with a sub-domain match',
+    },
+
+    {
+        'report': {
+            'all_domains': ['login-appleid.apple.com.managesuppport.co'],
+            'analysers': [
+                {
+                    'analyser': 'AhoCorasickDomainMatching',
+                    'domain': 'login-appleid.apple.com.managesuppport.co',
+                    'match': 'apple',
+                },
+            ],
+        },
+        'description': 'Report a phishing domain with a partial string match',
+    },
+
+    {
+        'report': {},
+        'description': 'Report nothing and thus will be ignored',
+    },
+)
+
+
 class FileReporterTest(unittest.TestCase):
     '''
     Test the file-based reporter.
@@ -16,68 +69,30 @@ class FileReporterTest(unittest.TestCase):
         '''
         Create a temporary file so that the test can write its reports into it.
         '''
-        self.tmp = tempfile.NamedTemporaryFile()
+        # The reporter opens the file on its own, so there is no need to keep
+        # this handle open. The file is removed when the tests are done
+        with tempfile.NamedTemporaryFile(delete=False) as tmp:
+            self.tmp = tmp
+
+        atexit.register(os.unlink, self.tmp.name)
         self.reporter = FileReporter(path=self.tmp.name)
 
     def test_report(self):
         '''
         Dump all the test reports to our temporary file.
         '''
-        cases = [
-            {
-                'report': {
-                    'all_domains': ['store.google.com', 'google.com'],
-                    'analysers': [
-                        {
-                            'analyser': 'AhoCorasickDomainMatching',
-                            'domain': 'store.google.com',
-                            'match': 'google',
-                        },
-                    ],
-                },
-                'description': 'Report an exact match domain',
-            },
-
-            {
-                'report': {
-                    'all_domains': ['www.facebook.com.msg40.site'],
-                    'analysers': [
-                        {
-                            'analyser': 'AhoCorasickDomainMatching',
-                            'domain': 'www.facebook.com.msg40.site',
-                            'match': 'facebook',
-                        },
-                    ],
-                },
-                'description': 'Report a phishing domain with a sub-domain match',
-            },
-
-            {
-                'report': {
-                    'all_domains': ['login-appleid.apple.com.managesuppport.co'],
-                    'analysers': [
-                        {
-                            'analyser': 'AhoCorasickDomainMatching',
-                            'domain': 'login-appleid.apple.com.managesuppport.co',
-                            'match': 'apple',
-                        },
-                    ],
-                },
-                'description': 'Report a phishing domain with a partial string match',
-            },
+        for case in _REPORT_CASES:
+            self.reporter.publish(case['report'])
 
-            {
-                'report': {},
-                'description': 'Report nothing and thus will be ignored',
-            },
-        ]
+        # The reports are buffered until then
+        self.reporter.flush()
 
-        for case in cases:
-            self.reporter.publish(case['report'])
+        # Empty reports are not written at all
+        expected = [case for case in _REPORT_CASES if case['report']]
 
         with open(self.tmp.name) as fhandler:
-            lines = fhandler.readlines()
-
-            for index, line in enumerate(lines):
+            for case, line in zip(expected, fhandler):
                 got = json.loads(line)
-                self.assertDictEqual(got, cases[index]['report'], cases[index]['description'])
+                self.assertDictEqual(got, case['report'], case['description'])
+
+            self.assertFalse(fhandler.readline(), 'Nothing is reported for the empty report')
@@ -1,25 +1,60 @@
 '''
 Test consuming the data from the great certstream.
 '''
-import time
+import os
+import socket
+import threading
 import unittest
+from urllib.parse import urlparse
 
 from certstream_analytics.analysers import Debugger
 from certstream_analytics.transformers import CertstreamTransformer
-from certstream_analytics.stream import CertstreamAnalytics
+from certstream_analytics.stream import CertstreamAnalytics, CERTSTREAM_URL
 
 
+class FirstRecordDebugger(Debugger):
+    '''
+    Let the test know as soon as the first record arrives.
+    '''
+    def __init__(self):
+        super().__init__()
+        self.first_record = threading.Event()
+
+    def run(self, record):
+        record = super().run(record)
+        self.first_record.set()
+
+        return record
+
+
+def _certstream_reachable(timeout=0.5):
+    '''
+    Quickly check if certstream can be reached at all, so that the test can
+    be skipped right away when running offline.
+    '''
+    url = urlparse(CERTSTREAM_URL)
+
+    try:
+        with socket.create_connection((url.hostname, url.port or 443), timeout=timeout):
+            return True
+    except OSError:
+        return False
+
+
+@unittest.skipUnless(_certstream_reachable(), 'certstream is unreachable')
 class CertstreamTest(unittest.TestCase):
     '''
     Test the way we consume data from certstream.
     '''
+    # The maximum number of seconds to wait for the data, it can be changed
+    # with the CERTSTREAM_TEST_TIMEOUT environment variable
     DEFAULT_DELAY = 30
 
     def setUp(self):
         '''
         Setup the client to consume from certstream.
         '''
-        self.debugger = Debugger()
+        self.debugger = FirstRecordDebugger()
         self.transformer = CertstreamTransformer()
 
         self.engine = CertstreamAnalytics(transformer=self.transformer,
@@ -31,8 +66,9 @@ class CertstreamTest(unittest.TestCase):
         '''
         self.engine.start()
 
-        # Wait a bit
-        time.sleep(CertstreamTest.DEFAULT_DELAY)
+        # Wait until the first record arrives
+        timeout = float(os.getenv('CERTSTREAM_TEST_TIMEOUT', CertstreamTest.DEFAULT_DELAY))
+        self.debugger.first_record.wait(timeout=timeout)
 
         self.engine.stop()
         # We should see some data coming already